@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# Description: add and list throughput of the sqlite engine,
+#              with the sqlite defaults versus the tuned options.
+#
+# Usage: bench/sqlite_rw.py [count]
+
+import sys, os
+import time
+import shutil
+import tempfile
+
+prog_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, prog_dir)
+sys.path.insert(0, os.path.join(prog_dir, 'lib'))
+
+from record import Record
+from sqlitestorage import SqliteStorage
+
+# what the engine got before it was tuned
+defaults = {
+    'journal_mode': 'DELETE',
+    'synchronous':  'FULL',
+    'mmap_size':    0,
+    'cache_size':   -2000,
+    'temp_store':   'DEFAULT',
+}
+
+
+def makeRecord(n):
+    now = int(time.time())
+    return Record(subject='subject of the log number %d' % n,
+                  author='Bench <bench@example.com>',
+                  time=now - n, mtime=now - n,
+                  scene='home', people='', tag='bench, test',
+                  data='some text data of the log\n' * 20,
+                  binary=False)
+
+
+def run(name, options, count):
+    dataDir = tempfile.mkdtemp()
+    try:
+        SqliteStorage.setup(dataDir, options)
+        start = time.time()
+        for n in range(count):
+            SqliteStorage.save(makeRecord(n))
+        addTime = time.time() - start
+
+        fields = list(Record.fields.keys())
+        start  = time.time()
+        total  = sum(1 for x in SqliteStorage.searchLogs(fields, {}))
+        listTime = time.time() - start
+        SqliteStorage.conn.close()
+    finally:
+        shutil.rmtree(dataDir)
+    print('%-8s add: %8.1f records/s    list: %10.1f records/s'
+          % (name, count / addTime, total / listTime))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    run('default', defaults, count)
+    run('tuned', None, count)
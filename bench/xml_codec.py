@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Description: encode and decode throughput of the xml engine's
+#              record codec, versus the minidom one it replaced,
+#              and a check that both produce the same files.
+#
+# Usage: bench/xml_codec.py [count]
+
+import sys, os
+import re
+import time
+
+prog_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, prog_dir)
+sys.path.insert(0, os.path.join(prog_dir, 'lib'))
+
+from record import Record
+from xmlstorage import XmlStorage
+
+
+def minidomToSource(recordData):
+    """ The former XmlStorage.recordToSource
+    """
+    from xml.dom.minidom import Document, Element, Text
+    doc  = Document()
+    root = doc.createElement("log")
+    doc.appendChild(root)
+    fields = Record.convertFields(dict(recordData).items(), False)
+    orders = {k: v['order'] for k, v in Record.fields.items()}
+    for name, value in sorted(fields.items(), key=lambda x: orders[x[0]]):
+        ele  = Element(name)
+        text = Text()
+        text.data = value
+        ele.appendChild(text)
+        root.appendChild(ele)
+    return re.sub('\t', ' ' * 4, doc.toprettyxml())
+
+
+def minidomToFields(code):
+    """ The former parsing of XmlStorage.load
+    """
+    from xml.dom.minidom import parseString
+    doc    = parseString(code)
+    fields = {}
+    for node in doc.firstChild.childNodes:
+        if node.nodeType == node.ELEMENT_NODE:
+            textNode = node.firstChild
+            fields[node.localName] = textNode.data if textNode else ''
+    return fields
+
+
+def makeRecord(n):
+    now = int(time.time())
+    return dict(id='%040x' % n,
+                subject='subject of the log number %d, "quoted" & <tagged>' % n,
+                author='Bench <bench@example.com>',
+                time=now - n, mtime=now - n,
+                scene='home', people='', tag='bench, test',
+                data='some text data\tof the log, 中文 ]]> &amp;\n' * 20,
+                binary=False)
+
+
+def measure(func, items):
+    start = time.time()
+    res   = [func(x) for x in items]
+    return res, len(items) / (time.time() - start)
+
+
+if __name__ == '__main__':
+    count   = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    records = [makeRecord(n) for n in range(count)]
+
+    oldCodes, oldEnc = measure(minidomToSource, records)
+    newCodes, newEnc = measure(XmlStorage.recordToSource, records)
+    assert oldCodes == newCodes, 'the files differ'
+
+    codes = [x.encode() for x in newCodes]
+    oldFields, oldDec = measure(minidomToFields, codes)
+    newFields, newDec = measure(XmlStorage.sourceToFields, codes)
+    assert oldFields == newFields, 'the fields differ'
+
+    print('%-8s encode: %9.1f records/s    decode: %9.1f records/s'
+          % ('minidom', oldEnc, oldDec))
+    print('%-8s encode: %9.1f records/s    decode: %9.1f records/s'
+          % ('codec', newEnc, newDec))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# Description: filter throughput of the xml engine's regular
+#              expression matching, the compiled matcher versus
+#              the former one that called re.search every time.
+#
+# Usage: bench/xml_filter.py [count] [patterns]
+
+import sys, os
+import re
+import time
+import random
+
+prog_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, prog_dir)
+sys.path.insert(0, os.path.join(prog_dir, 'lib'))
+
+from record import Record
+from xmlstorage import XmlStorage
+
+words = ('alpha beta gamma delta epsilon zeta theta kappa lambda sigma '
+         'dns web mail home office server client backup restore').split()
+
+
+def oldMatcher(patterns, allMatch):
+    """ The former matching of XmlStorage.makeFilter
+    """
+    def matcher(record):
+        texts = [record.author, record.subject, record.scene,
+                 record.people, record.tag]
+        if not record.binary:
+            texts.append(record.data)
+        for pat, flag, field in patterns:
+            inTexts = [getattr(record, field)] if field else texts
+            match = False
+            for text in inTexts:
+                if re.search(pat, text, flag):
+                    match = True
+                    break
+            if match != allMatch:
+                return not allMatch
+        return allMatch
+    return matcher
+
+
+def makeRecord(n):
+    pick = lambda k: ' '.join(random.choice(words) for i in range(k))
+    return Record(id='%040x' % n, subject=pick(6),
+                  author='Bench <bench@example.com>',
+                  time=n, mtime=n, scene=pick(1), people=pick(1),
+                  tag='%s, %s' % (pick(1), pick(1)),
+                  data='\n'.join(pick(10) for i in range(20)),
+                  binary=False)
+
+
+def makePatterns(count):
+    """ Half match a field, half any field, some ignore
+    case, there are more patterns than the re cache holds.
+    """
+    patterns = []
+    for n in range(count):
+        text  = '%s%d' % (random.choice(words)[:3], n)
+        flag  = re.I if n % 3 == 0 else 0
+        field = random.choice(['subject', 'tag', 'scene']) if n % 2 else None
+        patterns.append(('\\b%s\\b' % text, flag, field))
+    patterns.append(('%s %s' % (words[-1], words[0]), 0, None))
+    return patterns
+
+
+def run(name, matcher, records):
+    start = time.time()
+    count = sum(1 for x in records if matcher(x))
+    rate  = len(records) / (time.time() - start)
+    print('%-8s %10.1f records/s    %d matched' % (name, rate, count))
+    return count
+
+
+if __name__ == '__main__':
+    count    = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    nPattern = int(sys.argv[2]) if len(sys.argv) > 2 else 600
+    random.seed(0)
+    records  = [makeRecord(n) for n in range(count)]
+    patterns = makePatterns(nPattern)
+    for allMatch in (False, True):
+        print('all match: %s' % allMatch)
+        a = run('former', oldMatcher(patterns, allMatch), records)
+        b = run('compiled', XmlStorage.makeMatcher(patterns, allMatch), records)
+        assert a == b, 'the results differ'
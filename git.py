@@ -11,26 +11,93 @@ class Git:
     NOREMOTE = 3
     UNKNOWN  = 4
 
+    # objects requested from cat-file at a time
+    batchSize = 64
+
     def __init__(self, gitWorkTree, gitDir=None):
+        self.gitWorkTree = gitWorkTree
+        self.batchProc   = None
+        self.batchPid    = None
         if gitDir is None:
             gitDir = os.path.join(gitWorkTree, '.git')
-        self.gitWorkTree = gitWorkTree
-        self.gitDir      = gitDir
+            if not os.path.exists(gitDir) and self.isBare():
+                gitDir = gitWorkTree
+        self.gitDir = gitDir
         if not os.path.exists(gitDir):
             self.init()
 
+    def isBare(self):
+        """ Check if the work tree directory is itself a bare
+        repository, not a directory inside some other one.
+        """
+        cmd = ['git', 'rev-parse', '--is-bare-repository', '--absolute-git-dir']
+        stat, stdout, stderr = self.runCmd(cmd, quiet=True)
+        if not stat:
+            return False
+        lines = stdout.decode().split('\n')
+        return (lines[0] == 'true' and
+                os.path.realpath(lines[1]) == os.path.realpath(self.gitWorkTree))
+
     def commit(self, paths, message):
         """ Add the files of paths and create a commit
 
-        'paths' is a list of file paths, '-A' option
-        makes git to add the deleted files.
+        'paths' is a list of file paths, a path that no
+        longer exists is removed. Only the entries of the
+        paths are written to the index, the rest of the
+        work tree is never scanned, the commit is made of
+        the tree of the index by the plumbing commands.
+        Return the id of the commit created, or None, then
+        the entries of the paths are put back as in HEAD.
         """
-        cmd = ['git', 'add', '-A'] + paths
-        res = self.runCmd(cmd)
-        if not res[0]:
-            return False
-        cmd = ['git', 'commit', '-m', message]
+        paths   = [os.path.relpath(x, self.gitWorkTree) for x in paths]
+        present = [x for x in paths if os.path.exists(
+                        os.path.join(self.gitWorkTree, x))]
+        entries = []
+        if present:
+            cmd  = ['git', 'hash-object', '-w', '--stdin-paths']
+            data = ''.join(x + '\n' for x in present).encode()
+            stat, stdout, stderr = self.runCmd(cmd, input=data)
+            if not stat:
+                return None
+            shas = stdout.decode().split()
+            entries.extend('100644 %s\t%s' % x for x in zip(shas, present))
+        entries.extend('0 %s\t%s' % ('0' * 40, x) for x in paths if x not in present)
+        cmd  = ['git', 'update-index', '--index-info']
+        data = ''.join(x + '\n' for x in entries).encode()
+        if not self.runCmd(cmd, input=data)[0]:
+            return None
+        parent = self.head()
+        commit = self.commitIndex(parent, message)
+        if commit:
+            return commit
+        if parent:
+            cmd = ['git', 'reset', '-q', parent, '--'] + paths
+        else:
+            cmd = ['git', 'rm', '-q', '--cached', '--ignore-unmatch', '--'] + paths
         self.runCmd(cmd)
+        return None
+
+    def commitIndex(self, parent, message):
+        """ Create a commit of the tree of the index on top of
+        the commit parent, and move HEAD to it, return the id
+        of the commit, or None on failure.
+        """
+        stat, stdout, stderr = self.runCmd(['git', 'write-tree'])
+        if not stat:
+            return None
+        tree   = stdout.decode().strip()
+        cmd    = ['git', 'commit-tree', tree, '-m', message]
+        if parent:
+            cmd.extend(['-p', parent])
+        stat, stdout, stderr = self.runCmd(cmd)
+        if not stat:
+            return None
+        commit  = stdout.decode().strip()
+        subject = message.split('\n')[0]
+        cmd = ['git', 'update-ref', '-m', 'commit: %s' % subject, 'HEAD', commit]
+        if parent:
+            cmd.append(parent)
+        return commit if self.runCmd(cmd)[0] else None
 
     def init(self):
         """ Initialize a git repository
@@ -38,14 +105,14 @@ class Git:
         cmd = ['git', 'init']
         self.runCmd(cmd)
 
-    def runCmd(self, cmd, quiet=False):
-        """ Switch the working directory to the
-        GIT_DIR, then run git command there,
-        and then switch back.
+    def runCmd(self, cmd, quiet=False, input=None):
+        """ Run git command in the work tree, the
+        working directory of the process is left
+        alone, so threads can run commands at the
+        same time. 'input' is the bytes to feed
+        the command.
         """
-        owd = os.getcwd()
-        os.chdir(self.gitWorkTree)
-        res = applib.get_status_byte_output(cmd)
+        res = applib.get_status_byte_output(cmd, input, self.gitWorkTree)
         if not res[0] and not quiet:
             msg = 'git command failed:'
             if res[1]:
@@ -53,23 +120,92 @@ class Git:
             if res[2]:
                 msg += ('\n' + res[2].decode())
             print(msg, file=sys.stderr, end='')
-        os.chdir(owd)
         return res
 
-    def last(self, count=1):
-        """ Return the file paths of the last 'count'
-        commits that add or change a log, they're relative
-        paths, for an adding commit, there will be one
-        path, for a changing commit, it may be two.
+    def batchProcess(self):
+        """ Return the 'git cat-file --batch' process, it's
+        started at the first use, and serves the rest of the
+        command, a forked process starts its own one.
         """
-        paths = []
-        cmd   = ['git', 'log', '--grep=Add log', '--grep=Change log',
-                    '-%s' % count, '--pretty=format:', '--name-only']
-        stat, stdout, stderr = self.runCmd(cmd, quiet=True)
-        if stat:
-            paths = stdout.decode().strip().split('\n')
-            paths = [x for x in paths if x]
-        return paths
+        from subprocess import Popen, PIPE, DEVNULL
+        if self.batchProc is None or self.batchPid != os.getpid():
+            cmd = ['git', 'cat-file', '--batch']
+            self.batchProc = Popen(cmd, cwd=self.gitWorkTree, stdin=PIPE,
+                                   stdout=PIPE, stderr=DEVNULL)
+            self.batchPid  = os.getpid()
+        return self.batchProc
+
+    def catFiles(self, specs):
+        """ Yield the content of the objects of 'specs', like
+        'HEAD:path/of/file', as bytes, None for a missing one.
+        The requests are written to cat-file by groups, the
+        replies of a group are read before any is yielded, so
+        the process stays in step if the caller stops early.
+        """
+        proc  = self.batchProcess()
+        specs = list(specs)
+        for i in range(0, len(specs), self.batchSize):
+            group = specs[i:i+self.batchSize]
+            proc.stdin.write(b''.join([x.encode() + b'\n' for x in group]))
+            proc.stdin.flush()
+            replies = []
+            for spec in group:
+                header = proc.stdout.readline().split()
+                if len(header) != 3:    # '<spec> missing'
+                    replies.append(None)
+                    continue
+                data = proc.stdout.read(int(header[2]))
+                proc.stdout.read(1)     # the newline after the content
+                replies.append(data)
+            yield from replies
+
+    def catFile(self, rev, path):
+        """ Return the content of the file of path at the
+        commit rev, None if it does not exist.
+        """
+        return next(self.catFiles(['%s:%s' % (rev, path)]))
+
+    def lsTree(self, rev='HEAD'):
+        """ Return the paths of all files of the commit
+        rev, relative to the work tree.
+        """
+        cmd = ['git', 'ls-tree', '-r', '-z', '--name-only', rev]
+        stat, stdout, stderr = self.runCmd(cmd)
+        if not stat:
+            return []
+        return stdout.decode().split('\x00')[:-1]
+
+    def iterNameStatus(self, rev='HEAD'):
+        """ Yield (status, path) of the files changed by the
+        commits, from the commit rev backward, the status
+        is 'A', 'M', or 'D'. The output of git log is read as
+        it comes, git is stopped when the caller stops.
+        """
+        from subprocess import Popen, PIPE, DEVNULL
+        cmd  = ['git', 'log', '--name-status', '--no-renames',
+                '-z', '--pretty=format:', rev, '--']
+        proc = Popen(cmd, cwd=self.gitWorkTree, stdout=PIPE, stderr=DEVNULL)
+        try:
+            rest   = b''
+            status = None
+            while True:
+                chunk = proc.stdout.read(65536)
+                if not chunk:
+                    break
+                items = (rest + chunk).split(b'\x00')
+                rest  = items.pop()
+                for item in items:
+                    if not item:        # between commits
+                        continue
+                    if status is None:
+                        status = item.decode()
+                    else:
+                        yield status, item.decode()
+                        status = None
+        finally:
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
 
     def shadowInit(self):
         """ Initialize the shadow git
@@ -123,21 +259,125 @@ class Git:
         return (stat, stderr)
 
     def shadowMerge(self, remote, branch='master'):
-        """ Do a shadow-merge
+        """ Do a shadow-merge, return the code, the stderr,
+        and the commits of HEAD before and after the merge.
         """
         code = Git.UNKNOWN
+        before = after = None
         cmd  = ['git', 'checkout', branch]
         stat, stdout, stderr = self.runCmd(cmd, quiet=True)
         if stat:
-            plainBranch = 'plain-%s-%s' % (remote, branch)
-            cmd = ['git', 'shadow-merge', plainBranch]
+            before = self.head()
+            cmd = ['git', 'shadow-merge', self.plainBranch(remote, branch)]
             stat, stdout, stderr = self.runCmd(cmd, quiet=True)
             if not stat:
                 if b'CONFLICT' in stderr:
                     code = Git.CONFLICT
             else:
                 code = Git.SUCCESS
-        return (code, stderr)
+            after = self.head()
+        return (code, stderr, (before, after))
+
+    def plainBranch(self, remote, branch='master'):
+        """ Return the name of the branch that shadow-fetch
+        leaves the decrypted commits of the remote in.
+        """
+        return 'plain-%s-%s' % (remote, branch)
+
+    def syncState(self, remote, kind):
+        """ Return the commit last synced with the remote,
+        'kind' is 'pushed' for the commit of the last push,
+        'fetched' for the one of the last fetch that has been
+        merged, None if there is none.
+        """
+        return self.head('refs/log-sync/%s/%s' % (remote, kind))
+
+    def setSyncState(self, remote, kind, commit):
+        """ Record the commit synced with the remote, see
+        syncState, it's kept as a ref of the repository.
+        """
+        cmd = ['git', 'update-ref', 'refs/log-sync/%s/%s' % (remote, kind), commit]
+        return self.runCmd(cmd)[0]
+
+    def countCommits(self, rev, excludes=()):
+        """ Return the number of commits reachable from rev,
+        but not from any of the revs of 'excludes'.
+        """
+        cmd = ['git', 'rev-list', '--count', rev, '--not'] + list(excludes)
+        stat, stdout, stderr = self.runCmd(cmd)
+        return int(stdout) if stat else None
+
+    def head(self, rev='HEAD'):
+        """ Return the commit id of the 'rev', None if
+        it does not exist, like in an empty repository.
+        """
+        cmd = ['git', 'rev-parse', '-q', '--verify', '%s^{commit}' % rev]
+        stat, stdout, stderr = self.runCmd(cmd, quiet=True)
+        return stdout.decode().strip() if stat else None
+
+    def diffNameStatus(self, old, new='HEAD'):
+        """ Return the files changed between the commits 'old'
+        and 'new', a list of (status, path), the status is
+        'A', 'M', or 'D', renames are reported as a 'D' plus
+        an 'A', path is relative to the work tree.
+        """
+        cmd = ['git', 'diff', '--name-status', '--no-renames', '-z', old, new]
+        stat, stdout, stderr = self.runCmd(cmd)
+        if not stat:
+            return None
+        items = stdout.decode().split('\x00')[:-1]
+        return list(zip(items[0::2], items[1::2]))
+
+    def lsFiles(self):
+        """ Return the paths of all files in the index,
+        relative to the work tree.
+        """
+        cmd = ['git', 'ls-files', '-z']
+        stat, stdout, stderr = self.runCmd(cmd)
+        if not stat:
+            return []
+        return stdout.decode().split('\x00')[:-1]
+
+    def branch(self):
+        """ Return the full name of the branch of HEAD,
+        like 'refs/heads/master', None if it's detached.
+        """
+        cmd = ['git', 'symbolic-ref', '-q', 'HEAD']
+        stat, stdout, stderr = self.runCmd(cmd, quiet=True)
+        return stdout.decode().strip() if stat else None
+
+    def committer(self):
+        """ Return the committer identity git would use
+        now, like 'Name <email> 1452000000 +0800'.
+        """
+        cmd = ['git', 'var', 'GIT_COMMITTER_IDENT']
+        stat, stdout, stderr = self.runCmd(cmd)
+        return stdout.decode().strip() if stat else None
+
+    def fastImport(self, stream):
+        """ Run 'git fast-import', feed it the commands of
+        'stream', an iterable of bytes, as they come, return
+        True if all the commits are written and the refs are
+        updated.
+        """
+        from subprocess import Popen, PIPE
+        cmd  = ['git', 'fast-import', '--quiet', '--done']
+        proc = Popen(cmd, cwd=self.gitWorkTree, stdin=PIPE)
+        try:
+            for data in stream:
+                proc.stdin.write(data)
+            proc.stdin.write(b'done\n')
+        finally:
+            proc.stdin.close()
+            stat = proc.wait()
+        return stat == 0
+
+    def resetIndex(self):
+        """ Make the index the tree of HEAD, the work tree
+        is left alone, used after HEAD is moved by others.
+        """
+        cmd = ['git', 'reset', '-q']
+        return self.runCmd(cmd)[0]
 
     def allRemotes(self):
         """ Return a list of all remotes
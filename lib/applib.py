@@ -2,6 +2,7 @@ import sys, os
 from subprocess import Popen, PIPE
 import subprocess
 import base64
+import codecs
 import string
 import re
 import time
@@ -13,13 +14,16 @@ class InvalidFieldException(Exception): pass
 class InvalidCmdException(Exception): pass
 class NotTerminalException(Exception): pass
 
-def get_status_byte_output(cmd):
+def get_status_byte_output(cmd, input=None, cwd=None):
     """ Run the cmd, return the stdout and stderr as
     bytes objects, as well as the stat of the cmd
-    (True or False), cmd is a list.
+    (True or False), cmd is a list. 'input' is the
+    bytes to feed the cmd through its stdin, 'cwd'
+    is the directory to run it in.
     """
-    p       = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr  = p.communicate()
+    stdin   = PIPE if input is not None else None
+    p       = Popen(cmd, stdin=stdin, stdout=PIPE, stderr=PIPE, cwd=cwd)
+    stdout, stderr  = p.communicate(input)
     stat    = p.wait()
     pStat   = (stat == 0)
     res     = (pStat, stdout, stderr)
@@ -54,17 +58,13 @@ def isBinary(data):
 def b64encode(iData, lineLen=64):
     """ Take the data which is a bytes,
     encode it with base64, split the resulting
-    text into lines of 'lineLen', decode each
-    line (it was a bytes) to str, concatenate
-    them and return them as a whole long line.
+    text into lines of 'lineLen', and join
+    them with newlines into one str.
     """
     lineLen = lineLen // 4 * 4  # make it times of 4
-    oData   = base64.b64encode(iData)
-    res     = []
-    while oData:
-        line, oData = oData[:lineLen], oData[lineLen:]
-        res.append(line.decode())
-    return '\n'.join(res)
+    oData   = base64.b64encode(iData).decode()
+    lines   = [oData[i:i+lineLen] for i in range(0, len(oData), lineLen)]
+    return '\n'.join(lines)
 
 
 def b64decode(iData):
@@ -77,9 +77,75 @@ def b64decode(iData):
 def binToAsc(binData):
     """ Convert the binary data into ASCII form
     """
+    if isinstance(binData, FileData):
+        binData = binData.read()
     return b64encode(binData)
 
 
+class FileData:
+    """ Binary data kept in a file, it's copied in
+    chunks, never read into memory as a whole, unless
+    the read method is called.
+    """
+    chunkSize = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    def __len__(self):
+        return os.path.getsize(self.path)
+
+    def __eq__(self, other):
+        if isinstance(other, FileData):
+            return self.path == other.path
+        return False
+
+    def __str__(self):
+        return 'binary data in %s' % self.path
+
+    def chunks(self):
+        """ Yield the data chunk by chunk
+        """
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunkSize)
+                if not chunk:
+                    break
+                yield chunk
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def copyTo(self, path):
+        """ Write the data to the file of path
+        """
+        with open(path, 'wb') as f:
+            for chunk in self.chunks():
+                f.write(chunk)
+
+
+def spoolInput(iFile, path):
+    """ Copy the binary file object 'iFile' to the file of
+    'path' chunk by chunk, return True if the data is binary,
+    that is, not utf8 encoded, as isBinary tells.
+    """
+    decoder = codecs.getincrementaldecoder('utf8')()
+    binary  = False
+    with open(path, 'wb') as oFile:
+        while True:
+            chunk = iFile.read(FileData.chunkSize)
+            if not binary:
+                try:
+                    decoder.decode(chunk, final=(not chunk))
+                except UnicodeDecodeError:
+                    binary = True
+            if not chunk:
+                break
+            oFile.write(chunk)
+    return binary
+
+
 class Pager:
     """ Read data from the stdin, write it
     to the stdout using the LESS program
@@ -149,6 +215,33 @@ def pageOut(records_data, formater, color=True):
     pager.go()
 
 
+def splitFacet(text):
+    """ Split the text of a multi-value field, like the tag,
+    into a sorted list of the distinct values in lower case,
+    values are separated by commas, as interact.readstr does.
+    """
+    values = [x.strip().lower() for x in re.split('[,，]', text or '')]
+    return sorted(set([x for x in values if x]))
+
+
+def parseFacet(text):
+    """ Parse the argument of a facet option, values
+    separated by '+' must all match, values separated
+    by ',' need any one to match, return the values
+    and whether all of them must match. The two can not
+    be mixed, repeat the option for both, which must all
+    match.
+    """
+    if '+' in text and re.search('[,，]', text):
+        raise InvalidFieldException("both '+' and ',' in facet values: %s"
+                                    ", repeat the option instead" % text)
+    allMatch = '+' in text
+    values   = splitFacet(text.replace('+', ','))
+    if not values:
+        raise InvalidFieldException("invalid facet values: %s" % text)
+    return values, allMatch
+
+
 def validateTime(timeStr):
     """ Check the time string format
     Only check the textual format, not the meaning
@@ -209,6 +302,10 @@ def parsePattern(pstr):
         if not v:       # unsupported flag
             raise InvalidReException("invalid pattern: %s" % pstr)
         flagVal |= v
+    try:
+        re.compile(pattern, flagVal)
+    except re.error:    # not a valid regular expression
+        raise InvalidReException("invalid pattern: %s" % pstr)
     lField = field.lower()
     if lField:
         checkFieldName(lField)
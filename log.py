@@ -1,4 +1,4 @@
-import sys
+import sys, os
 from git import Git
 from record import Record
 from xmlstorage  import XmlStorage
@@ -31,6 +31,8 @@ class Engine:
                     'allIds',
                     'load',
                     'searchLogs',
+                    'countLogs',
+                    'statLogs',
                    ]
         if name in attrList:
             return getattr(self.engines['sqlite'], name)
@@ -46,8 +48,11 @@ class Engine:
         r = self.engines['sqlite'].save(record, oldRecord, commit=False)
         if r:
             record.id = r.id    # when add, the ID will be new generated.
+            synced = self.inSync()
             r = self.engines['xml'].save(record, oldRecord)
             if r:
+                if synced:
+                    self.markSynced()
                 self.engines['sqlite'].commit()
             else:
                 print('xml engine failed, roll back sqlite engine actions',
@@ -59,14 +64,31 @@ class Engine:
         """ Delete records from all engines
         Procedure:
             1. delete from sqlite engine, but not commit
-            2. delete from xml engine (git commit created here)
+            2. delete from xml engine the records that sqlite
+               engine deleted (git commit created here)
             3. commit in sqlite if xml engine return success
                or do a roll back
+        The sqlite engine is only marked in sync if both
+        engines have deleted the same records.
         """
-        s = self.engines['sqlite'].delete(ids, preAction, postAction, commit=False)
-        if s:
-            s = self.engines['xml'].delete(ids) # no need to confirm/inform again
+        deleted = []
+        def sqlitePostAction(record):
+            deleted.append(record.id)
+            postAction(record)
+
+        s = self.engines['sqlite'].delete(ids, preAction, sqlitePostAction,
+                                          commit=False)
+        if s and not deleted:
+            self.engines['sqlite'].rollback()
+        elif s:
+            synced = self.inSync()
+            xmlDeleted = []
+            # no need to confirm/inform again
+            s = self.engines['xml'].delete(deleted, preAction=(lambda x: True),
+                                postAction=(lambda x: xmlDeleted.append(x.id)))
             if s:
+                if synced and sorted(xmlDeleted) == sorted(deleted):
+                    self.markSynced()
                 self.engines['sqlite'].commit()
             else:
                 print('xml engine failed, roll back sqlite engine actions',
@@ -74,6 +96,68 @@ class Engine:
                 self.engines['sqlite'].rollback()
 
 
+    def importRecords(self, records, commitSize=0):
+        """ Save many new records to all engines
+        Procedure:
+            1. stream the records to the xml engine, which
+               writes them through one git process
+            2. save them to sqlite engine on the way, by
+               batches, but not commit
+            3. commit in sqlite if xml engine return success,
+               along with the new commit of the xml engine as
+               the one in sync, if it was before, or do a roll
+               back
+        A record whose id exists already is skipped.
+        Return the number of records imported and skipped.
+        """
+        eXml    = self.engines['xml']
+        eSqlite = self.engines['sqlite']
+        size    = eSqlite.options['bulk_batch']
+        synced  = self.inSync()
+        known   = eXml.getManifest()
+        batch   = []
+        skipped = 0
+
+        def feed():
+            nonlocal skipped
+            for record in records:
+                if not getattr(record, 'id', None):
+                    record.id = applib.genId(record.time)
+                elif record.id in known:
+                    skipped += 1
+                    continue
+                yield record
+                batch.append(record)
+                if len(batch) == size:
+                    eSqlite.applyChanges(batch, [], commit=False)
+                    batch.clear()
+
+        try:
+            count = eXml.importRecords(feed(), commitSize)
+        except:
+            print('xml engine failed, roll back sqlite engine actions',
+                    file=sys.stderr)
+            eSqlite.rollback()
+            raise
+        meta  = {'xmlHead': eXml.git.head()} if synced else None
+        eSqlite.applyChanges(batch, [], meta)
+        return count, skipped
+
+    def inSync(self):
+        """ Check if the sqlite engine reflects the current
+        commit of the xml engine, both are None when new.
+        """
+        head = self.engines['xml'].git.head()
+        return self.engines['sqlite'].getMeta('xmlHead') == head
+
+    def markSynced(self):
+        """ Record the current commit of the xml engine as
+        the one that the sqlite engine reflects, not commit.
+        """
+        head = self.engines['xml'].git.head()
+        self.engines['sqlite'].setMeta('xmlHead', head)
+
+
 class Log:
     """ Log management class
     """
@@ -86,8 +170,9 @@ class Log:
         engine   = Engine()
         eXml     = engine.engines['xml']
         eSqlite  = engine.engines['sqlite']
-        self.git = eXml.setup(dataDir)   # Xml storage engine uses git
-        eSqlite.setup(dataDir)
+        self.git = eXml.setup(dataDir, config.get('xmlWorkers'),
+                              config.get('xmlRev'))    # Xml storage engine uses git
+        eSqlite.setup(dataDir, config.get('sqliteOptions'))
         Record.engine = engine
 
     def lastLog(self):
@@ -100,7 +185,7 @@ class Log:
         When interactive is True, ask data for subject, time, scene,
         people, tag, and log data from the use interactively, the
         provided arguments are used as the default value for user's
-        choice.
+        choice. Return True if the record is saved.
         """
 
         if interactive:
@@ -115,10 +200,35 @@ class Log:
             fields = Record.convertFields(fields.items())
             record = Record(**fields)
             record.save()
+            return True
         except:
             if fail_callback:
                 data = '%s\n\n%s' % (fields['subject'], fields['data'])
                 fail_callback(data)
+            return False
+
+    def importRecords(self, items, commitSize=0):
+        """ Add many records at a time, 'items' is an iterable
+        of dicts of the fields, consumed as it goes. The author
+        defaults to the configured one, mtime to the time, id
+        to a new one. Return the number of records imported,
+        and the number of those skipped for existing already.
+        """
+        author = '%s <%s>' % (self.config['authorName'],
+                              self.config['authorEmail'])
+
+        def toRecords():
+            for fields in items:
+                fields = dict(fields)
+                fields.setdefault('author', author)
+                fields.setdefault('mtime', fields.get('time'))
+                for name in Record.fields:
+                    fields.setdefault(name, '')
+                assert self.checkRequirement(**fields), \
+                        "field data not sufficient: %s" % fields.get('id', '')
+                yield Record(**Record.convertFields(fields.items()))
+
+        return Record.engine.importRecords(toRecords(), commitSize)
 
     def _list(self, fields, criteria, order, engine=None):
         """ Caller can specify an engine
@@ -127,6 +237,49 @@ class Log:
             engine = Record.engine
         return engine.searchLogs(fields, criteria, order)
 
+    def count(self, criteria, engine=None):
+        """ Return the number of records matching the
+        criteria, the engine counts them if it can.
+        """
+        if not engine:
+            engine = Record.engine
+        countLogs = getattr(engine, 'countLogs', None)
+        if countLogs:
+            return countLogs(criteria)
+        return sum(1 for x in engine.searchLogs(['id'], criteria))
+
+    def stats(self, by, criteria):
+        """ Count the records matching the criteria by
+        the groups of 'by', return a list of (group, count).
+        """
+        return Record.engine.statLogs(by, criteria)
+
+    def syncSqlite(self, old=None, new=None):
+        """ Apply the changes of the xml engine between the
+        commits 'old' and 'new' to the sqlite engine, in one
+        transaction. 'old' defaults to the commit that the
+        sqlite engine reflects, 'new' defaults to HEAD.
+        Return the number of records deleted and saved, or
+        None if there is no known commit to start from.
+        """
+        eXml    = Record.engine.engines['xml']
+        eSqlite = Record.engine.engines['sqlite']
+        old     = old or eSqlite.getMeta('xmlHead')
+        new     = new or self.git.head()
+        if not old:
+            return None
+        if old == new:
+            return (0, 0)
+        changes = self.git.diffNameStatus(old, new)
+        if changes is None:
+            return None
+        changes = [x for x in changes if eXml.isRecordPath(x[1])]
+        ids     = [os.path.basename(p) for stat, p in changes if stat == 'D']
+        paths   = [p for stat, p in changes if stat != 'D']
+        records = [eXml.load(None, os.path.join(eXml.dataDir, p)) for p in paths]
+        records = [x for x in records if x]
+        return eSqlite.applyChanges(records, ids, {'xmlHead': new})
+
     def checkRequirement(self, **args):
         """ Check if all required fields are provided
         """
@@ -154,9 +307,8 @@ class Log:
         ID is acceptable, so that 297aacc is the equivalent
         of 297aacc3863171ed86ba89a2ea0e88f9c4d99d48.
         """
-        allIds = Record.allIds()
-        ids = [storedId for storedId in allIds for id in ids
-                    if id and storedId.startswith(id)]
+        ids = [storedId for id in ids if id
+                    for storedId in Record.matchId(id)]
         if force:
             preAction = lambda x: True
         if not preAction:  preAction  = self.preActionOfDelete
@@ -194,7 +346,17 @@ class Log:
         print(msg, file=sys.stderr)
 
     def push(self, remote):
-        """ Sync with the git server
+        """ Sync with the git server, return True on success
+        """
+        return self.syncRemotes([remote], push=True)[remote]
+
+    def fetch(self, remote):
+        """ Fetch from the git server, return True on success
+        """
+        return self.syncRemotes([remote], push=False)[remote]
+
+    def syncRemotes(self, remotes, push=True):
+        """ Push to, or fetch from, the remotes one by one
 
         Push using shadow-git tools, first shadow-push,
         if rejected because of unfetched update on the
@@ -203,23 +365,89 @@ class Log:
         that can not be automatically resolved, exit,
         after manually solved the conflict, user can
         then try to push again.
+
+        The remotes are done one after another, for the
+        shadow-git tools encrypt and decrypt through the
+        local shadow repository, along with the network
+        transfer, as one unit. A failed remote does not
+        stop the others. Return a dict of remote --> True/False.
+
+        A remote that has got the current HEAD by the last
+        push is not pushed again, a fetch that brings no new
+        commit since the last merge is not merged, see
+        Git.syncState.
         """
-        if not self.preActionOfPushAndFetch(remote):
-            return False
+        status = {}
+        ready  = []
+        head   = self.git.head()
+        for remote in remotes:      # may ask for the address
+            if push and head and self.git.syncState(remote, 'pushed') == head:
+                print('%s: up to date.' % remote)
+                status[remote] = True
+            elif self.preActionOfPushAndFetch(remote):
+                ready.append(remote)
+            else:
+                status[remote] = False
+        for remote in ready:
+            if push:
+                status[remote] = self.pushRemote(remote)
+            else:
+                status[remote] = self.fetchRemote(remote)
+        return status
 
-        for i in range(2):              # try twice at most
-            print('pushing...')
+    def pushRemote(self, remote):
+        """ Push to the remote, fetch and merge first if the
+        push is rejected, return True on success.
+        """
+        for retry in (False, True):
+            print('%s: pushing...' % remote)
+            head = self.git.head()  # what the push sends at least
             stat, msg = self.git.shadowPush(remote)
-            if stat == Git.TOFETCH:
-                print('push rejected, need to fetch')
-                if self.fetch(remote):
-                    continue
-            elif stat == Git.UNKNOWN:
-                self.perror('unknown error:\n' + msg.decode())
-            elif stat == Git.SUCCESS:
-                print('push done.')
+            if stat == Git.SUCCESS:
+                if head:
+                    self.git.setSyncState(remote, 'pushed', head)
+                print('%s: push done.' % remote)
                 return True
+            elif stat == Git.TOFETCH and not retry:
+                print('%s: push rejected, need to fetch' % remote)
+                if not self.fetchRemote(remote, quiet=True):
+                    return False
+            else:
+                if stat == Git.UNKNOWN:
+                    self.perror('%s: unknown error:\n%s' % (remote, msg.decode()))
+                return False
+
+    def fetchRemote(self, remote, quiet=False):
+        """ Fetch from the remote and merge, return True on
+        success, 'quiet' is for a fetch done for a push.
+        """
+        print('%s: fetching...' % remote)
+        stat, msg = self.git.shadowFetch(remote)
+        if not stat:
+            self.perror('%s: fetch failed:\n%s' % (remote, msg.decode()))
+            return False
+        if not self.merge(remote):
             return False
+        if not quiet:
+            print('%s: fetch done.' % remote)
+        return True
+
+
+    def syncStatus(self, remote):
+        """ Return the number of commits the HEAD is ahead of
+        the remote, and behind it, by what was last pushed to
+        and fetched from it, no network is involved. Behind is
+        None if nothing has been fetched, and so are both if
+        there is no HEAD yet.
+        """
+        if not self.git.head():
+            return None, None
+        pushed  = self.git.syncState(remote, 'pushed')
+        fetched = self.git.head(self.git.plainBranch(remote))
+        known   = [x for x in (pushed, fetched) if x]
+        ahead   = self.git.countCommits('HEAD', known)
+        behind  = self.git.countCommits(fetched, ['HEAD']) if fetched else None
+        return ahead, behind
 
 
     def preActionOfPushAndFetch(self, remote):
@@ -232,29 +460,46 @@ class Log:
         return True
 
 
-    def fetch(self, remote):
-        """ Fetch from the git server
+    def merge(self, remote):
+        """ Merge the fetched changes of the remote, unless
+        they are the ones merged last time.
         """
-        if not self.preActionOfPushAndFetch(remote):
-            return False
-
-        print('fetching...')
-        stat, msg = self.git.shadowFetch(remote)
-        if not stat:
-            self.perror('fetch failed:\n' + msg.decode())
-        else:
-            print('merging...')
-            stat, msg = self.git.shadowMerge(remote)
-            if stat == Git.SUCCESS:
-                print('fetch done.')
-                return True
-            elif stat == Git.UNKNOWN:
-                self.perror('unknown error:\n' + msg.decode())
-            elif stat == Git.CONFLICT:
-                self.perror('automatic merge failed, fix the conflict, and retry')
+        fetched = self.git.head(self.git.plainBranch(remote))
+        if fetched and fetched in (self.git.syncState(remote, 'fetched'),
+                                   self.git.head()):
+            self.git.setSyncState(remote, 'fetched', fetched)
+            print('%s: nothing new to merge.' % remote)
+            return True
+        print('%s: merging...' % remote)
+        stat, msg, commits = self.git.shadowMerge(remote)
+        if stat == Git.SUCCESS:
+            if fetched:
+                self.git.setSyncState(remote, 'fetched', fetched)
+                if commits[1] == fetched:   # a fast-forward, nothing to push
+                    self.git.setSyncState(remote, 'pushed', fetched)
+            self.postActionOfMerge(*commits)
+            return True
+        elif stat == Git.UNKNOWN:
+            self.perror('%s: unknown error:\n%s' % (remote, msg.decode()))
+        elif stat == Git.CONFLICT:
+            self.perror('%s: automatic merge failed, fix the conflict, and retry' % remote)
         return False
 
 
+    def postActionOfMerge(self, before, after):
+        """ Bring the records merged in to the sqlite engine,
+        start from the commit the sqlite engine reflects, or
+        from the commit before the merge if none recorded.
+        """
+        eSqlite = Record.engine.engines['sqlite']
+        old     = eSqlite.getMeta('xmlHead') or before
+        res     = self.syncSqlite(old, after)
+        if res is None:
+            self.perror('sqlite not updated, run "man unity" to sync it')
+        elif res != (0, 0):
+            print('sqlite updated: %s records deleted, %s records saved' % res)
+
+
     """ Methods defined below are Record definition specific,
     subclasses shall redefine/extend these methods according
     to the Record fields definition, or add more others.
@@ -366,5 +611,6 @@ class Log:
         """
         conv = Record.getConv('time', toRecord=False)
         elements['time'] = conv(elements['time'])
-        elements['data'] = elements['data'].encode()
+        if not isinstance(elements['data'], bytes):   # binary is bytes
+            elements['data'] = elements['data'].encode()
         return elements
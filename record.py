@@ -1,6 +1,16 @@
 import os
 from  timeutils import isodatetime, strtosecond
 
+def keepBinary(value):
+    """ The data of a binary record is bytes, or an object
+    that refers to the bytes, like applib.FileData, it is
+    kept as it is, other values are converted to str.
+    """
+    if isinstance(value, (bytes, str)) or hasattr(value, 'chunks'):
+        return value
+    return str(value)
+
+
 class BasicRecord:
     """ Define the basic methods of a record
 
@@ -57,8 +67,8 @@ class Record(BasicRecord):
         'scene':   {'order': 6},
         'people':  {'order': 7},
         'tag':     {'order': 8},
-        'data':    {'order': 9},
-        'binary':  {'order': 10, 'conv': [(lambda s: s == 'true'),
+        'data':    {'order': 9, 'conv': [keepBinary, keepBinary]},
+        'binary':  {'order': 10, 'conv': [(lambda s: s in (True, 'true')),
                          (lambda v: ['false', 'true'][bool(v)])]},
     }
     sep = ':'  # separator between key and value
@@ -1,39 +1,650 @@
 import os
 from record import Record
-from timeutils import isodatetime
+from timeutils import isostrtosecond
 import applib
 import sqlite3
+import functools
+import itertools
+import base64
+import json
+import re
+import zlib
+try:
+    import re._parser as sre_parse
+except ImportError:     # before Python 3.11
+    import sre_parse
 
 class E:
     """ sqlite3 storage engine for the record
     """
     recordTbl = 'record'
+    ftsTbl    = 'record_fts'
     orderBy   = 'mtime'
     orderHow  = 'desc'
+    # text fields covered by the full-text index
+    ftsFields = ['author', 'subject', 'scene', 'people', 'tag', 'data']
+    # multi-value fields that are split into the facet table
+    facetFields = ['tag', 'people', 'scene']
+    # periods that the statistics can be grouped by
+    statPeriods = {'year': '%Y', 'month': '%Y-%m', 'day': '%Y-%m-%d',
+                   'hour': '%Y-%m-%d %H'}
+    # how many compiled regular expressions to keep
+    reCache   = 256
+    metaTbl   = 'meta'
+    facetTbl  = 'facet'
+    schemaVersion = 8
+    # converters of the fields: [Record --> db, db --> Record],
+    # no converter means the value is kept as it is.
+    conv = {
+        'id':     [bytes.fromhex, bytes.hex],
+        'binary': [int, bool],
+        'data':   [lambda x: E.deflate(x), lambda x: E.inflate(x)],
+    }
+    # a compressed data value is a BLOB of the marker byte
+    # followed by the zlib stream, text values are plain,
+    # the data of a binary record is the raw bytes after
+    # the rawMarker byte
+    zMarker   = b'\x01'
+    rawMarker = b'\x00'
+    # the text form of the columns that are not text
+    columnText = {'id': 'lower(hex(id))',
+                  'time': "strftime('%Y-%m-%d %H:%M:%S', time, 'unixepoch', 'localtime')",
+                  'mtime': "strftime('%Y-%m-%d %H:%M:%S', mtime, 'unixepoch', 'localtime')",
+                  'data': 'inflate(iif(binary, NULL, data))'}
+    # tunables, can be overridden by the 'sqliteOptions' config,
+    # fetch_size: rows to fetch at a time when searching,
+    # bulk_batch: rows to insert at a time when bulk loading,
+    # busy_timeout: milliseconds to wait for a locked database,
+    # cached_statements: size of the statement cache of sqlite3,
+    # compress_min: data of this many bytes or more is stored
+    # compressed, 0 turns the compression off,
+    # the others are pragmas, None keeps the sqlite default.
+    # E.options is what E.setup makes of them and the config.
+    defaultOptions = {
+        'fetch_size':        256,
+        'bulk_batch':        10000,
+        'busy_timeout':      5000,
+        'cached_statements': 128,
+        'compress_min':      1024,
+        'journal_mode':      'WAL',
+        'synchronous':       'NORMAL',
+        'mmap_size':         256 * 1024 * 1024,
+        'cache_size':        -16384,    # negative means KiB
+        'temp_store':        'MEMORY',
+    }
+    options = dict(defaultOptions)
+    pragmas = ['journal_mode', 'synchronous', 'mmap_size',
+               'cache_size', 'temp_store']
+    # SQL statements by name, see E.statement
+    statements = {
+        'insert':   lambda flds: 'INSERT INTO %s (%s) VALUES (%s)' % (
+                        E.recordTbl, ','.join(flds), ','.join('?' * len(flds))),
+        'update':   lambda flds: 'UPDATE %s SET %s WHERE id = ?' % (
+                        E.recordTbl, ','.join(['%s=?' % k for k in flds])),
+        'upsert':   lambda flds: '%s ON CONFLICT (id) DO UPDATE SET %s' % (
+                        E.statement('insert', flds),
+                        ','.join(['%s=excluded.%s' % (k, k) for k in flds])),
+        'delete':   lambda: 'DELETE FROM %s WHERE id = ?' % E.recordTbl,
+        'facetInsert': lambda: 'INSERT INTO %s (rid, kind, value) VALUES (?, ?, ?)' % (
+                        E.facetTbl),
+        'facetDelete': lambda: 'DELETE FROM %s WHERE rid = ?' % E.facetTbl,
+        'load':     lambda flds, where: 'SELECT %s FROM %s WHERE %s LIMIT 1' % (
+                        ','.join(flds), E.recordTbl, where),
+        'matchId':  lambda where: 'SELECT id FROM %s WHERE %s' % (
+                        E.recordTbl, where),
+        'allIds':   lambda: 'SELECT id FROM %s' % E.recordTbl,
+        'lastLogs': lambda flds: 'SELECT %s FROM %s ORDER BY %s %s LIMIT ?' % (
+                        ','.join(flds), E.recordTbl, E.orderBy, E.orderHow),
+    }
+    sqlCache = {}
 
     @staticmethod
-    def setup(dataDir):
+    def setup(dataDir, options=None):
+        """ Open the database, 'options' is a dict that
+        overrides the items of E.defaultOptions.
+        """
         engineDir = os.path.join(dataDir, 'sqlite3')
         os.makedirs(engineDir, exist_ok=True)
         dbPath    = os.path.join(engineDir, 'db.sqlite3')
-        E.conn    = sqlite3.connect(dbPath)
+        E.options = dict(E.defaultOptions, **(options or {}))
+        timeout   = E.options['busy_timeout'] / 1000
+        cached    = E.options['cached_statements']
+        E.conn    = sqlite3.connect(dbPath, timeout=timeout,
+                                    cached_statements=cached)
         E.fields  = list(Record.fields.keys())
+        E.tune(E.conn)
+        E.createFunctions(E.conn)
         E.createTables(E.conn)
 
     @staticmethod
-    def createTables(conn):
+    def tune(conn):
+        """ Apply the pragmas in E.options to the connection
+        """
         cur = conn.cursor()
-        sql = "SELECT name FROM sqlite_master WHERE type='table' AND name='%s'" % E.recordTbl
-        if cur.execute(sql).fetchone():
+        for name in E.pragmas:
+            value = E.options.get(name)
+            if value is not None:
+                cur.execute('PRAGMA %s = %s' % (name, value))
+
+    @staticmethod
+    def statement(name, *args):
+        """ Return the SQL of the named statement, it is composed
+        only once for the same arguments, and the same text is
+        used every time, so that the statement cache of sqlite3
+        gets hits. The arguments shall be hashable, like tuples
+        of field names, or SQL fragments.
+        """
+        key = (name,) + args
+        sql = E.sqlCache.get(key)
+        if sql is None:
+            sql = E.statements[name](*args)
+            E.sqlCache[key] = sql
+        return sql
+
+    @staticmethod
+    def createFunctions(conn):
+        """ Register the SQL functions of the engine on the
+        connection: regexp(pattern, text[, flags]), which
+        also serves the 'text REGEXP pattern' operator, and
+        inflate(data), the text of a data column value.
+        """
+        conn.create_function('regexp', 2, E.regexp, deterministic=True)
+        conn.create_function('regexp', 3, E.regexp, deterministic=True)
+        conn.create_function('inflate', 1, E.inflate, deterministic=True)
+
+    @staticmethod
+    def deflate(text):
+        """ Return the column value of the data text, it's
+        compressed if it's large enough, and gets smaller.
+        Binary data is kept raw.
+        """
+        if isinstance(text, applib.FileData):
+            text = text.read()
+        if isinstance(text, bytes):
+            return E.rawMarker + text
+        limit = E.options['compress_min']
+        if not limit or text is None or len(text) < limit:
+            return text
+        value = E.zMarker + zlib.compress(text.encode())
+        return value if len(value) < len(text) else text
+
+    @staticmethod
+    def inflate(value):
+        """ Return the data text of the column value, values
+        stored before the compression are text already, the
+        data of a binary record is returned as bytes.
+        """
+        if isinstance(value, bytes):
+            if value[:1] == E.zMarker:
+                return zlib.decompress(value[1:]).decode()
+            if value[:1] == E.rawMarker:
+                return value[1:]
+        return value
+
+    @staticmethod
+    def writeBlob(cur, id, fileData):
+        """ Write the applib.FileData as the data of the record
+        of id, which is in the column form, chunk by chunk, the
+        data is never read into memory as a whole. Before Python
+        3.11 there is no incremental blob I/O, the data is read
+        and bound as a whole then.
+        """
+        if not hasattr(E.conn, 'blobopen'):
+            sql = 'UPDATE %s SET data = ? WHERE id = ?' % E.recordTbl
+            cur.execute(sql, [E.rawMarker + fileData.read(), id])
             return
+        size = len(fileData) + len(E.rawMarker)
+        sql  = 'UPDATE %s SET data = zeroblob(?) WHERE id = ?' % E.recordTbl
+        cur.execute(sql, [size, id])
+        rid  = cur.execute(E.statement('load', ('_id',), 'id = ?'), [id]).fetchone()[0]
+        with E.conn.blobopen(E.recordTbl, 'data', rid) as blob:
+            blob.write(E.rawMarker)
+            for chunk in fileData.chunks():
+                blob.write(chunk)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=reCache)
+    def compilePattern(pattern, flags=0):
+        """ Compile the pattern, the most recently used
+        ones are kept, keyed by the pattern and the flags.
+        """
+        return re.compile(pattern, flags)
+
+    @staticmethod
+    def regexp(pattern, text, flags=0):
+        """ True if the pattern matches anywhere in the text,
+        the same as re.search does, non-text never matches.
+        """
+        if not isinstance(text, str):
+            return False
+        return E.compilePattern(pattern, flags).search(text) is not None
+
+    @staticmethod
+    def literal(pattern, flags=0):
+        """ Return the longest literal text that any string
+        matched by the pattern must contain, or '' if there
+        is none, a pattern of alternatives has none. Also
+        return the flags the text is matched with, which
+        include the inline flags of the pattern, like (?i).
+        """
+        try:
+            parsed = sre_parse.parse(pattern, flags)
+        except re.error:
+            return '', flags
+        # the parser state is named 'pattern' before Python 3.8
+        state = getattr(parsed, 'state', None) or parsed.pattern
+        best = text = ''
+        for op, av in parsed:
+            if op is sre_parse.LITERAL:
+                text += chr(av)
+                continue
+            best = max(best, text, key=len)
+            text = ''
+        return max(best, text, key=len), flags | state.flags
+
+    @staticmethod
+    def createTables(conn):
+        """ Create the tables of the current schema version, or
+        upgrade the tables of an older version. The version
+        is kept in the user_version of the database, the very
+        first schema has no version recorded, it's version 1.
+        """
+        cur = conn.cursor()
+        exists = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
+        if not cur.execute(exists, [E.recordTbl]).fetchone():
+            cur.execute('begin')
+            E.createRecordTable(cur)
+            E.createIndexes(cur)
+            E.createMetaTable(cur)
+            E.createFacetTable(cur)
+            E.createFacetIndexes(cur)
+            cur.execute('PRAGMA user_version = %d' % E.schemaVersion)
+            conn.commit()
+        else:
+            version = cur.execute('PRAGMA user_version').fetchone()[0]
+            version = max(version, 1)
+            for upgrade in E.upgrades[(version - 1):]:
+                upgrade(conn)
+        if not cur.execute(exists, [E.ftsTbl]).fetchone():
+            E.createFts(conn)
+
+    @staticmethod
+    def createRecordTable(cur):
+        """ Create the record table, times are integer seconds
+        since the epoch, the id is the 20 bytes of the sha1
+        sum instead of the hex text, binary is 1 or 0.
+        """
+        sql = 'CREATE TABLE %s (_id INTEGER PRIMARY KEY AUTOINCREMENT, id BLOB NOT NULL, subject TEXT NOT NULL, author TEXT NOT NULL, time INTEGER NOT NULL, mtime INTEGER NOT NULL, scene TEXT, people TEXT, tag TEXT, data BLOB, binary TINYINT NOT NULL)'
+        cur.execute(sql % E.recordTbl)
+
+    @staticmethod
+    def createMetaTable(cur):
+        """ Create the table of the key/value facts about the
+        database, like the xml engine commit it reflects.
+        """
+        sql = 'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT)'
+        cur.execute(sql % E.metaTbl)
+
+    @staticmethod
+    def createFacetTable(cur):
+        """ Create the table of the individual values of the
+        multi-value fields, one row for each value of each
+        record, the rows go away along with the record.
+        """
+        tbl = E.facetTbl
+        sql = 'CREATE TABLE %s (rid INTEGER NOT NULL, kind TEXT NOT NULL, value TEXT NOT NULL)'
+        cur.execute(sql % tbl)
+        sql = 'CREATE TRIGGER %s_ad AFTER DELETE ON %s BEGIN DELETE FROM %s WHERE rid = old._id; END'
+        cur.execute(sql % (tbl, E.recordTbl, tbl))
+
+    @staticmethod
+    def createFacetIndexes(cur):
+        """ Create the indexes of the facet table
+        """
+        tbl = E.facetTbl
+        cur.execute('CREATE INDEX %s_value_idx ON %s (kind, value, rid)' % (tbl, tbl))
+        cur.execute('CREATE INDEX %s_rid_idx ON %s (rid)' % (tbl, tbl))
+
+    @staticmethod
+    def facetRows(rid, data):
+        """ Return the facet rows of a record, 'rid' is the
+        row id of the record, 'data' is a dict of the fields.
+        """
+        return [(rid, kind, value) for kind in E.facetFields
+                    for value in applib.splitFacet(data.get(kind))]
+
+    @staticmethod
+    def saveFacets(cur, id):
+        """ Replace the facet rows of the record of the id,
+        which is in the column form.
+        """
+        flds = ['_id'] + E.facetFields
+        sql  = E.statement('load', tuple(flds), 'id = ?')
+        row  = cur.execute(sql, [id]).fetchone()
+        rid  = row[0]
+        cur.execute(E.statement('facetDelete'), [rid])
+        rows = E.facetRows(rid, dict(zip(flds, row)))
+        cur.executemany(E.statement('facetInsert'), rows)
+
+    @staticmethod
+    def fillFacets(cur):
+        """ Create the facet rows of all records
+        """
+        flds = ['_id'] + E.facetFields
+        sql  = 'SELECT %s FROM %s' % (','.join(flds), E.recordTbl)
+        rows = (x for row in cur.execute(sql).fetchall()
+                    for x in E.facetRows(row[0], dict(zip(flds, row))))
+        cur.executemany(E.statement('facetInsert'), rows)
+
+    @staticmethod
+    def createIndexes(cur):
+        """ Create the indexes of the record table
+        """
+        tbl = E.recordTbl
+        cur.execute('CREATE UNIQUE INDEX record_id_idx ON %s (id)' % tbl)
+        E.createTimeIndexes(cur)
+
+    @staticmethod
+    def createTimeIndexes(cur):
+        """ Create the indexes of the time fields, the id is
+        included, so that the (time, id) order of the keyset
+        paging comes right from the index.
+        """
+        tbl = E.recordTbl
+        cur.execute('CREATE INDEX record_time_idx ON %s (time, id)' % tbl)
+        cur.execute('CREATE INDEX record_mtime_idx ON %s (mtime, id)' % tbl)
+
+    @staticmethod
+    def upgradeToV2(conn):
+        """ Version 1 stores times as text, the id as hex
+        text, and binary as 'true'/'false', convert them
+        to integer seconds, 20 bytes, and 1/0 respectively.
+        """
+        conn.create_function('_seconds', 1, isostrtosecond)
+        conn.create_function('_unhex', 1, bytes.fromhex)
+        tbl  = E.recordTbl
+        flds = ','.join(['_id'] + E.fields)
+        vals = ['_unhex(id)' if k == 'id' else
+                '_seconds(%s)' % k if k in ('time', 'mtime') else
+                "binary = 'true'" if k == 'binary' else
+                k for k in E.fields]
+        vals = ','.join(['_id'] + vals)
+        cur  = conn.cursor()
+        cur.execute('begin')
+        E.dropFts(conn)
+        cur.execute('ALTER TABLE %s RENAME TO %s_v1' % (tbl, tbl))
+        for name in ['record_id_idx', 'record_time_idx', 'record_mtime_idx']:
+            cur.execute('DROP INDEX IF EXISTS %s' % name)
+        E.createRecordTable(cur)
+        sql = 'INSERT INTO %s (%s) SELECT %s FROM %s_v1'
+        cur.execute(sql % (tbl, flds, vals, tbl))
+        cur.execute('DROP TABLE %s_v1' % tbl)
+        E.createIndexes(cur)
+        cur.execute('PRAGMA user_version = 2')
+        conn.commit()
+
+    @staticmethod
+    def upgradeToV3(conn):
+        """ Version 3 adds the meta table
+        """
+        cur = conn.cursor()
         cur.execute('begin')
-        sql = 'CREATE TABLE IF NOT EXISTS record (_id INTEGER PRIMARY KEY AUTOINCREMENT, id CHAR(40) NOT NULL, subject TEXT NOT NULL, author TEXT NOT NULL, time DATETIME NOT NULL, mtime DATETIME NOT NULL, scene TEXT, people TEXT, tag TEXT, data BLOB, binary TINYINT NOT NULL)'
+        E.createMetaTable(cur)
+        cur.execute('PRAGMA user_version = 3')
+        conn.commit()
+
+    @staticmethod
+    def upgradeToV4(conn):
+        """ Version 4 adds the id to the time indexes
+        """
+        cur = conn.cursor()
+        cur.execute('begin')
+        cur.execute('DROP INDEX IF EXISTS record_time_idx')
+        cur.execute('DROP INDEX IF EXISTS record_mtime_idx')
+        E.createTimeIndexes(cur)
+        cur.execute('PRAGMA user_version = 4')
+        conn.commit()
+
+    @staticmethod
+    def upgradeToV5(conn):
+        """ Version 5 adds the facet table
+        """
+        cur = conn.cursor()
+        cur.execute('begin')
+        E.createFacetTable(cur)
+        E.fillFacets(cur)
+        E.createFacetIndexes(cur)
+        cur.execute('PRAGMA user_version = 5')
+        conn.commit()
+
+    @staticmethod
+    def upgradeToV6(conn):
+        """ Version 6 may store the data compressed, the
+        full-text index reads it with inflate(). The stored
+        data is left as it is, it's compressed when written
+        again.
+        """
+        cur = conn.cursor()
+        cur.execute('begin')
+        cur.execute('PRAGMA user_version = 6')
+        conn.commit()
+
+    @staticmethod
+    def upgradeToV7(conn):
+        """ Version 7 keeps the data of a binary record as
+        raw bytes instead of the base64 text.
+        """
+        rawData = lambda x: E.deflate(applib.b64decode(E.inflate(x) or ''))
+        conn.create_function('raw_data', 1, rawData)
+        cur = conn.cursor()
+        cur.execute('begin')
+        sql = 'UPDATE %s SET data = raw_data(data) WHERE binary' % E.recordTbl
+        cur.execute(sql)
+        cur.execute('PRAGMA user_version = 7')
+        conn.commit()
+
+    @staticmethod
+    def upgradeToV8(conn):
+        """ Version 8 keeps the full-text index in sync from
+        the engine instead of by triggers, which call inflate(),
+        a function that other sqlite clients do not have.
+        """
+        cur = conn.cursor()
+        cur.execute('begin')
+        E.dropFtsTriggers(cur)
+        cur.execute('PRAGMA user_version = 8')
+        conn.commit()
+
+    @staticmethod
+    def createFts(conn):
+        """ Create the full-text index of the record table,
+        then index the existing records. The trigram tokenizer
+        is used, so that a word matches anywhere in the text,
+        like the LIKE operator does. The data of a binary
+        record is not indexed. The engine keeps the index in
+        sync with the record table, see E.ftsDelete, other
+        sqlite clients do not.
+        """
+        tbl  = E.ftsTbl
+        flds = ','.join(E.ftsFields)
+        cur  = conn.cursor()
+        cur.execute('begin')
+        cur.execute("CREATE VIRTUAL TABLE %s USING fts5(%s, content='%s', "
+                    "content_rowid='_id', tokenize='trigram')"
+                    % (tbl, flds, E.recordTbl))
+        sql = 'INSERT INTO %s (rowid,%s) SELECT _id,%s FROM %s'
+        sql = sql % (tbl, flds, E.ftsValues(E.recordTbl), E.recordTbl)
         cur.execute(sql)
-        cur.execute('CREATE INDEX record_id_idx ON record (id)')
-        cur.execute('CREATE INDEX record_time_idx ON record (time)')
-        cur.execute('CREATE INDEX record_mtime_idx ON record (mtime)')
         conn.commit()
 
+    @staticmethod
+    def ftsValues(table):
+        """ Return the SQL of the values of the full-text
+        index columns of a row of the table.
+        """
+        data = "CASE WHEN %s.binary THEN '' ELSE inflate(%s.data) END"
+        return ','.join(['%s.%s' % (table, k) for k in E.ftsFields[:-1]]
+                        + [data % (table, table)])
+
+    @staticmethod
+    def ftsDelete(cur, where, vals):
+        """ Remove the rows of the record table that match the
+        SQL condition 'where' from the full-text index, it's
+        done before the rows are changed or deleted.
+        """
+        tbl = E.ftsTbl
+        sql = "INSERT INTO %s (%s,rowid,%s) SELECT 'delete',_id,%s FROM %s WHERE %s" % (
+                tbl, tbl, ','.join(E.ftsFields), E.ftsValues(E.recordTbl),
+                E.recordTbl, where)
+        cur.execute(sql, vals)
+
+    @staticmethod
+    def ftsInsert(cur, where, vals):
+        """ Add the rows of the record table that match the SQL
+        condition 'where' to the full-text index, it's done
+        after the rows are added or changed.
+        """
+        tbl = E.ftsTbl
+        sql = 'INSERT INTO %s (rowid,%s) SELECT _id,%s FROM %s WHERE %s' % (
+                tbl, ','.join(E.ftsFields), E.ftsValues(E.recordTbl),
+                E.recordTbl, where)
+        cur.execute(sql, vals)
+
+    @staticmethod
+    def dropFtsTriggers(cur):
+        """ Drop the triggers of the full-text index, which
+        kept it in sync before version 8
+        """
+        for suffix in ['ai', 'ad', 'au']:
+            cur.execute('DROP TRIGGER IF EXISTS %s_%s' % (E.ftsTbl, suffix))
+
+    @staticmethod
+    def dropFts(conn):
+        """ Drop the full-text index and its triggers
+        """
+        cur = conn.cursor()
+        E.dropFtsTriggers(cur)
+        cur.execute('DROP TABLE IF EXISTS %s' % E.ftsTbl)
+
+    @staticmethod
+    def dropTables(conn):
+        """ Drop the record table, its full-text index,
+        and the facet table.
+        """
+        cur = conn.cursor()
+        E.dropFts(conn)
+        cur.execute('DROP TABLE IF EXISTS %s' % E.facetTbl)
+        cur.execute('DROP TABLE IF EXISTS %s' % E.recordTbl)
+
+    @staticmethod
+    def bulkLoad(conn, records):
+        """ Replace all records in the database of 'conn' with
+        the 'records', an iterable of dicts of the record
+        fields, return the number of records loaded.
+
+        The table is created without indexes, the rows go in
+        by batches in one transaction, the facets and the
+        indexes are built at the end, and the full-text index
+        in one pass after.
+        Meanwhile there is no sync and the journal is kept in
+        memory, a crash may damage the database, which can be
+        rebuilt from the xml engine anyway.
+        """
+        size  = E.options['bulk_batch']
+        sql   = E.statement('insert', tuple(E.fields))
+        convs = [(k, E.conv[k][0] if k in E.conv else None) for k in E.fields]
+        rows  = ([c(data[k]) if c else data[k] for k, c in convs]
+                    for data in records)
+        cur   = conn.cursor()
+        E.createFunctions(conn)
+        journal = cur.execute('PRAGMA journal_mode').fetchone()[0]
+        sync    = cur.execute('PRAGMA synchronous').fetchone()[0]
+        cur.execute('PRAGMA journal_mode = MEMORY')
+        cur.execute('PRAGMA synchronous = OFF')
+        count = 0
+        try:
+            cur.execute('begin')
+            E.dropTables(conn)
+            E.createRecordTable(cur)
+            while True:
+                batch = list(itertools.islice(rows, size))
+                if not batch:
+                    break
+                cur.executemany(sql, batch)
+                count += len(batch)
+            E.createFacetTable(cur)
+            E.fillFacets(cur)
+            E.createIndexes(cur)
+            E.createFacetIndexes(cur)
+            E.createMetaTable(cur)
+            cur.execute('PRAGMA user_version = %d' % E.schemaVersion)
+            conn.commit()
+            E.createFts(conn)
+        except:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute('PRAGMA journal_mode = %s' % journal)
+            cur.execute('PRAGMA synchronous = %s' % sync)
+        return count
+
+    @staticmethod
+    def getMeta(key, conn=None):
+        """ Return the value of the key in the meta table
+        """
+        conn = conn or E.conn
+        sql  = 'SELECT value FROM %s WHERE key = ?' % E.metaTbl
+        row  = conn.execute(sql, [key]).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def setMeta(key, value, conn=None):
+        """ Set the value of the key in the meta table,
+        the caller shall do the commit.
+        """
+        conn = conn or E.conn
+        sql  = 'INSERT OR REPLACE INTO %s (key, value) VALUES (?, ?)'
+        conn.execute(sql % E.metaTbl, [key, value])
+
+    @staticmethod
+    def applyChanges(records, ids, meta=None, commit=True):
+        """ Delete the records of 'ids', then add the 'records',
+        which are Record instances, an existing one of the same
+        id is replaced, and set the key/value pairs of the dict
+        'meta', all in one transaction. If 'commit' is False,
+        the transaction is left open, a later call continues
+        it. Return the number of records deleted and the number
+        of records saved.
+        """
+        cur = E.conn.cursor()
+        try:
+            if not E.conn.in_transaction:
+                cur.execute('begin')
+            sql = E.statement('delete')
+            deleted = 0
+            for id in ids:
+                id = bytes.fromhex(id)
+                E.ftsDelete(cur, 'id = ?', [id])
+                cur.execute(sql, [id])
+                deleted += cur.rowcount
+            sql   = E.statement('upsert', tuple(E.fields))
+            saved = 0
+            for record in records:
+                data = E.convertFields(record.elements().items())
+                E.ftsDelete(cur, 'id = ?', [data['id']])
+                cur.execute(sql, [data[k] for k in E.fields])
+                E.saveFacets(cur, data['id'])
+                E.ftsInsert(cur, 'id = ?', [data['id']])
+                saved += 1
+            for key, value in (meta or {}).items():
+                E.setMeta(key, value)
+            if commit:
+                E.commit()
+        except:
+            E.rollback()
+            raise
+        return deleted, saved
+
     @staticmethod
     def commit():
         """ Do a database transaction commit
@@ -51,14 +662,13 @@ class E:
         """ Load the content of the record from disk,
         parse it, and return a record instance.
         """
-        fields = ','.join(E.fields)
-        table  = E.recordTbl
-        sql    = 'SELECT %s FROM %s WHERE id LIKE ?' % (fields, table)
+        where, vals = E.idWhere(id)
+        sql    = E.statement('load', tuple(E.fields), where)
         cur    = E.conn.cursor()
-        cur.execute(sql, ['%%%s%%' % id])
-        elements = cur.fetchall()
+        cur.execute(sql, vals)
+        elements = cur.fetchone()
         if elements:
-            record = E._elements_to_record(E.fields, elements[0])
+            record = E._elements_to_record(E.fields, elements)
         else:
             record = None
         return record
@@ -67,15 +677,36 @@ class E:
     def matchId(id):
         """ Return all IDs that starts with 'id'
         """
-        table = E.recordTbl
-        sql   = 'select id from %s where id like ?' % table
-        val   = [id + '%']
+        where, val = E.idWhere(id)
+        sql   = E.statement('matchId', where)
         cur   = E.conn.cursor()
         cur.execute(sql, val)
         ids   = cur.fetchall()
-        ids   = [x[0] for x in ids]
+        ids   = [x[0].hex() for x in ids]
         return ids
 
+    @staticmethod
+    def idWhere(id):
+        """ Return the SQL condition and its values that match
+        the ids starting with 'id', a complete id is compared
+        for equality, a partial one becomes a range of the id
+        index, so that a lookup never scans the table.
+        """
+        id = id.lower()
+        try:
+            if len(id) == 40:
+                return 'id = ?', [bytes.fromhex(id)]
+            odd  = len(id) % 2
+            low  = bytes.fromhex(id + '0' * odd)
+            high = bytes.fromhex(id + 'f' * odd)
+        except ValueError:      # not a hex text, matches nothing
+            return '0', []
+        # the first id after all ids of the prefix
+        high = int.from_bytes(high, 'big') + 1
+        if high >> (8 * len(low)):  # all 0xff, no upper bound
+            return 'id >= ?', [low]
+        return 'id >= ? AND id < ?', [low, high.to_bytes(len(low), 'big')]
+
     @staticmethod
     def save(record, oldRecord=None, commit=True):
         """ For add and change a record.
@@ -83,17 +714,19 @@ class E:
         an existing record, else it's to add a new one.
         if 'commit' is True, do a commit to the db.
         """
-        tbl  = E.recordTbl
-        data = dict(record.elements()).items()
-        data = Record.convertFields(data, False)
+        data = dict(record.elements())
         if not oldRecord:   # add new record
             record.id  = applib.genId(record.time)
             data['id'] = record.id
+        # the data in a file is written after the row
+        blob = data['data'] if isinstance(data['data'], applib.FileData) else None
+        if blob:
+            data['data'] = None
+        data = E.convertFields(data.items())
+        if not oldRecord:
             # insert
-            flds = ','.join(E.fields)
-            hlds = ','.join(['?'] * len(E.fields))
             vals = [data[k] for k in E.fields]
-            sql  = 'INSERT INTO %s (%s) VALUES (%s)' % (tbl, flds, hlds)
+            sql  = E.statement('insert', tuple(E.fields))
         else:
             if record == oldRecord:
                 return
@@ -105,13 +738,18 @@ class E:
                 if vnew != vold:
                     keys.append(k)
             vals = [data[k] for k in keys]
-            pairs = ','.join(['%s=?'] * len(keys)) % tuple(keys)
-            sql = 'UPDATE %s SET %s WHERE id = ?' % (tbl, pairs)
-            vals.append(record.id)
+            sql  = E.statement('update', tuple(keys))
+            vals.append(data['id'])
         try:
             cur = E.conn.cursor()
             cur.execute('begin')
+            if oldRecord:
+                E.ftsDelete(cur, 'id = ?', [data['id']])
             cur.execute(sql, vals)
+            if blob:
+                E.writeBlob(cur, data['id'], blob)
+            E.saveFacets(cur, data['id'])
+            E.ftsInsert(cur, 'id = ?', [data['id']])
             if commit:
                 E.commit()
             return record
@@ -122,18 +760,17 @@ class E:
     def allIds():
         """ Return a generator which yields IDs of all log records.
         """
-        table = E.recordTbl
-        sql   = 'select id from %s' % table
+        sql   = E.statement('allIds')
         cur   = E.conn.cursor()
         cur.execute(sql)
         for (id,) in cur:
-            yield id
+            yield id.hex()
 
     @staticmethod
     def delete(ids, preAction=(lambda x:False), postAction=(lambda x:0), commit=True):
         """ Delete multiple records
         """
-        sql = 'DELETE from %s WHERE id = ?' % E.recordTbl
+        sql = E.statement('delete')
         try:
             cur = E.conn.cursor()
             cur.execute('begin')
@@ -141,7 +778,8 @@ class E:
                 record = SqliteStorage.load(id)
                 if not preAction(record):
                     continue
-                cur.execute(sql, [id])
+                E.ftsDelete(cur, 'id = ?', [bytes.fromhex(id)])
+                cur.execute(sql, [bytes.fromhex(id)])
                 postAction(record)
             if commit:
                 E.commit()
@@ -166,33 +804,80 @@ class E:
         the fields and elements shall match
         in order.
         """
-        D = Record.convertFields(zip(fields, elements))
+        D = E.convertFields(zip(fields, elements), False)
         return Record(**D)
 
+    @staticmethod
+    def convertFields(items, toDb=True):
+        """ Convert the record data in items, which is an
+        iterable of key/value pairs, into the column values
+        if toDb is True, else do a reverse conversion.
+        """
+        res = {}
+        idx = 0 if toDb else 1
+        for k, v in items:
+            conv = E.conv.get(k)
+            res[k] = conv[idx](v) if conv else v
+        return res
+
     @staticmethod
     def lastLogs(count=1):
         """ Fetch the last 'count' logs record
         """
         records  = []
-        fields   = ','.join(E.fields)
-        table    = E.recordTbl
-        orderBy  = E.orderBy
-        orderHow = E.orderHow
-        sql = 'SELECT %s FROM %s ORDER BY %s %s LIMIT %s'
-        sql = sql % (fields, table, orderBy, orderHow, count)
+        sql = E.statement('lastLogs', tuple(E.fields))
         cur = E.conn.cursor()
-        cur.execute(sql)
+        cur.execute(sql, [count])
         records_elements = cur.fetchall()
         for elements in records_elements:
             record = E._elements_to_record(E.fields, elements)
             records.append(record)
         return records
 
+    @staticmethod
+    def ftsQuery(text, field=None):
+        """ Return the full-text query that finds the records
+        containing the text, or None if the full-text index
+        can not answer it. The trigram index needs three or
+        more characters, and matches case insensitively, so
+        the result is a superset of what the pattern matches.
+        """
+        if len(text) < 3:
+            return None
+        if field and field not in E.ftsFields:
+            return None
+        query = '"%s"' % text.replace('"', '""')
+        if field:
+            query = '%s : %s' % (field, query)
+        return query
+
+    @staticmethod
+    def preFilter(text, flags, columns):
+        """ Return the SQL and the values that cheaply find the
+        rows whose any of the columns contains the text, it's
+        used before the costly regexp, or None if unavailable.
+        LIKE ignores case only for ASCII characters.
+        """
+        if not text:
+            return None
+        if not flags & re.IGNORECASE:
+            sql = 'instr(%s, ?) > 0'
+            val = text
+        elif text.isascii():
+            sql = "%s LIKE ? ESCAPE '\\'"
+            val = '%%%s%%' % re.sub(r'([%_\\])', r'\\\1', text)
+        else:
+            return None
+        sqls = ' OR '.join([sql % x for x in columns])
+        return '(%s)' % sqls, [val] * len(columns)
+
     @staticmethod
     def procTimeAndRe(criteria):
         """ Parse the criteria, produce the SQL and the Values
-        time points in the criteria are unix timestamps, they
-        must be converted to text format to suit the SQL needs.
+        time points in the criteria are unix timestamps, the
+        same as the time columns.
+        Also return the full-text query composed of all the
+        patterns that the full-text index helps, for ranking.
         """
         whereSql  = ''
         whereVals = []
@@ -200,7 +885,6 @@ class E:
         times    = criteria.get('times')
         tmField  = times.get('field') if times else None
         tmPoints = times.get('points', []) if times else []
-        tmPoints = [(isodatetime(t1), isodatetime(t2)) for t1, t2 in tmPoints]
         regxs    = criteria.get('regxs')
         allMatch = regxs.get('allMatch', False) if regxs else False
         patterns = regxs.get('patterns') if regxs else []
@@ -213,30 +897,49 @@ class E:
             tmVals.extend([t1, t2])
         tmSqls = ' OR '.join(tmSqls)
 
-        # the regular expression matching SQL (LIKE for now )
-        # unfortunately, Python sqlites module seems not support RE
-        # we use LIKE operator instead, temporarily.
+        # the regular expression matching SQL, the regexp
+        # function only runs on the rows that pass the full-
+        # text index or a cheap text search, when the pattern
+        # contains a literal text.
         matchSqls = []
         matchVals = []
+        ftsQuerys = []
+        ftsSql    = '_id IN (SELECT rowid FROM %s WHERE %s MATCH ?)'
+        ftsSql    = ftsSql % (E.ftsTbl, E.ftsTbl)
         texts = ['author', 'subject', 'scene', 'people', 'tag']
         for pat, flag, field in patterns:
             """ one pattern against all texts,
             or a specific field.
             """
-            pat = '%%%s%%' % pat    # A 'in' LIKE
             if field:
-                matchSqls.append('%s LIKE ?' % field)
-                matchVals.append(pat)
+                column  = E.columnText.get(field, field)
+                columns = [column]
+                sqls    = ['regexp(?, %s, ?)' % column]
+                vals    = [pat, flag]
             else:
-                ss = ['%s LIKE ?' % x for x in texts]
-                ss.append("(binary = 'false' AND data LIKE ?)")
-                ss = ' OR '.join(ss)
-                matchSqls.append('(%s)' % ss)
-                matchVals.extend([pat] * (len(texts) + 1))
+                columns = texts + [E.columnText['data']]
+                sqls    = ['regexp(?, %s, ?)' % x for x in texts]
+                sqls.append("(NOT binary AND regexp(?, inflate(data), ?))")
+                vals    = [pat, flag] * (len(texts) + 1)
+            sql     = ' OR '.join(sqls)
+            literal, lFlag = E.literal(pat, flag)
+            query   = E.ftsQuery(literal, field)
+            where   = E.preFilter(literal, lFlag, columns)
+            if query:
+                sql  = '%s AND (%s)' % (ftsSql, sql)
+                vals = [query] + vals
+                ftsQuerys.append('(%s)' % query)
+            elif where:
+                sql  = '%s AND (%s)' % (where[0], sql)
+                vals = where[1] + vals
+            matchSqls.append('(%s)' % sql)
+            matchVals.extend(vals)
         if allMatch:
             matchSqls = ' AND '.join(matchSqls)
+            ftsQuery  = ' AND '.join(ftsQuerys)
         else:
             matchSqls = ' OR '.join(matchSqls)
+            ftsQuery  = ' OR '.join(ftsQuerys)
 
         subSqls = []
         if tmSqls:
@@ -247,33 +950,162 @@ class E:
             whereVals.extend(matchVals)
         whereSql = ' AND '.join(subSqls)
 
-        return whereSql, whereVals
+        return whereSql, whereVals, ftsQuery
 
     @staticmethod
-    def searchLogs(fields, criteria, order=None):
-        """ Collect records that match the criteria. Only
-        collect fields that in 'fields', return a generator
-        which yields a dict for all requested fields.
+    def pageToken(data, orderBy, orderHow):
+        """ Return the opaque token of the position after the
+        record 'data', a dict that has the orderBy and the id.
+        """
+        value = data[orderBy]
+        if isinstance(value, bool):
+            value = int(value)
+        text  = json.dumps([orderBy, orderHow.upper(), value, data['id']])
+        return base64.urlsafe_b64encode(text.encode()).decode()
+
+    @staticmethod
+    def parseToken(token, orderBy, orderHow):
+        """ Parse the page token, return the SQL condition and
+        its values that select the records after the position.
+        """
+        try:
+            text = base64.urlsafe_b64decode(token.encode()).decode()
+            by, how, value, id = json.loads(text)
+            id = bytes.fromhex(id)
+        except (ValueError, TypeError):
+            assert False, 'invalid page token: %s' % token
+        assert (by, how) == (orderBy, orderHow.upper()), \
+                'the page token is for another order'
+        value = E.convertFields([(by, value)])[by]
+        op    = '<' if how == 'DESC' else '>'
+        return '(%s, id) %s (?, ?)' % (by, op), [value, id]
+
+    @staticmethod
+    def facetWhere(facets):
+        """ Return the WHERE clause and its values for the
+        facets, a list of (kind, values, allMatch), a record
+        matches a facet if it has any one of the values, or
+        all of them when 'allMatch' is true, and it must match
+        all the facets.
+        """
+        ss   = []
+        vals = []
+        for kind, values, allMatch in facets:
+            sql = 'SELECT rid FROM %s WHERE kind = ? AND value IN (%s)' % (
+                        E.facetTbl, ','.join('?' * len(values)))
+            vals.append(kind)
+            vals.extend(values)
+            if allMatch and len(values) > 1:
+                sql += ' GROUP BY rid HAVING count(*) = ?'
+                vals.append(len(values))
+            ss.append('_id IN (%s)' % sql)
+        return ' AND '.join(ss), vals
+
+    @staticmethod
+    def searchWhere(criteria):
+        """ Return the WHERE clause, its values, and the
+        full-text query for ranking, of the search criteria.
         """
         whereSql  = ''
         whereVals = []
-        # the WHERE clause
+        ftsQuery  = ''
         ids = criteria.get('ids')
         if ids:
-            ss = ' OR '.join(['id LIKE ?'] * len(ids))
-            whereSql  = '(%s)' % ss
             # the provided partial id matches the start of the record's id
-            whereVals = ['%s%%' % id for id in ids]
+            ss = []
+            for id in ids:
+                where, vals = E.idWhere(id)
+                ss.append('(%s)' % where)
+                whereVals.extend(vals)
+            whereSql  = '(%s)' % ' OR '.join(ss)
         elif criteria and (criteria.get('times') or criteria.get('regxs')):
-            whereSql, whereVals = E.procTimeAndRe(criteria)
+            whereSql, whereVals, ftsQuery = E.procTimeAndRe(criteria)
+        facets = criteria.get('facets')
+        if facets:
+            where, vals = E.facetWhere(facets)
+            whereSql = '(%s) AND %s' % (whereSql, where) if whereSql else where
+            whereVals.extend(vals)
+        return whereSql, whereVals, ftsQuery
 
-        # construct a complete SQL
-        table = E.recordTbl
-        sql   = 'SELECT %s FROM %s' % (','.join(fields), table)
-        vals  = []
+    @staticmethod
+    def matchSql(criteria):
+        """ Return the SQL that selects the row id of the
+        records matching the criteria, and its values. With
+        a limit, only the last records in the default order
+        are taken, as searchLogs does.
+        """
+        whereSql, vals, ftsQuery = E.searchWhere(criteria)
+        sql = 'SELECT _id FROM %s' % E.recordTbl
         if whereSql:
             sql += ' WHERE %s' % whereSql
-            vals.extend(whereVals)
+        if criteria.get('limit'):
+            sql += ' ORDER BY %s %s, id %s LIMIT ?' % (
+                        E.orderBy, E.orderHow, E.orderHow)
+            vals.append(criteria['limit'])
+        return sql, vals
+
+    @staticmethod
+    def countLogs(criteria):
+        """ Return the number of records matching the
+        criteria, no record is loaded.
+        """
+        sql, vals = E.matchSql(criteria)
+        sql = 'SELECT count(*) FROM (%s)' % sql
+        return E.conn.execute(sql, vals).fetchone()[0]
+
+    @staticmethod
+    def statLogs(by, criteria):
+        """ Count the records matching the criteria by groups,
+        return a list of (group, count). The group is a period
+        of the time field, or a value of a field, each value of
+        the tag, people or scene is a group of its own.
+        Periods come in time order, values by count, the most
+        frequent first.
+        """
+        sql, vals = E.matchSql(criteria)
+        if by in E.statPeriods:
+            times = criteria.get('times')
+            field = times['field'] if times else 'time'
+            group = "strftime('%s', %s, 'unixepoch', 'localtime')" % (
+                        E.statPeriods[by], field)
+            sql   = ('SELECT %s AS g, count(*) FROM %s WHERE _id IN (%s)'
+                     ' GROUP BY g ORDER BY g') % (group, E.recordTbl, sql)
+        elif by in E.facetFields:
+            sql   = ('SELECT value, count(*) AS n FROM %s'
+                     ' WHERE kind = ? AND rid IN (%s)'
+                     ' GROUP BY value ORDER BY n DESC, value') % (E.facetTbl, sql)
+            vals  = [by] + vals
+        else:
+            assert by in E.fields and by not in ('data', 'binary'), \
+                    'can not group by: %s' % by
+            group = E.columnText.get(by, by)
+            sql   = ('SELECT %s AS g, count(*) AS n FROM %s WHERE _id IN (%s)'
+                     ' GROUP BY g ORDER BY n DESC, g') % (group, E.recordTbl, sql)
+        return E.conn.execute(sql, vals).fetchall()
+
+    @staticmethod
+    def searchLogs(fields, criteria, order=None):
+        """ Collect records that match the criteria. Only
+        collect fields that in 'fields', return a generator
+        which yields a dict for all requested fields.
+
+        The criteria['facets'] matches the individual values
+        of the tag, people and scene through the facet table.
+
+        When ordered by 'rank', records are sorted by their
+        bm25 relevance to the literal text of the patterns,
+        the most relevant first, records not ranked come last.
+
+        Records are ordered by the order field and then the
+        id, when criteria['page'] is set, at most that many
+        records are returned, starting after the position of
+        the token criteria['after'], and when there may be
+        more, the token of the next page is set to the
+        criteria['next'] after the last record is yielded.
+        """
+        fields = list(fields)
+        whereSql, whereVals, ftsQuery = E.searchWhere(criteria)
+
         if order:
             orderBy  = order['by']
             orderHow = 'ASC' if order['ascending'] else 'DESC'
@@ -281,16 +1113,66 @@ class E:
             # apply the default order
             orderBy  = E.orderBy
             orderHow = E.orderHow
-        orderSql = ' ORDER BY %s %s' % (orderBy, orderHow)
+        page  = criteria.get('page')
+        after = criteria.get('after')
+        assert not ((page or after) and orderBy == 'rank'), \
+                'no paging when sorted by rank'
+
+        # the position to start at, and the columns it needs
+        columns = fields[:]
+        if page:
+            columns.extend([x for x in (orderBy, 'id') if x not in fields])
+        if after:
+            where, vals = E.parseToken(after, orderBy, orderHow)
+            whereSql = '(%s) AND %s' % (whereSql, where) if whereSql else where
+            whereVals.extend(vals)
+
+        # construct a complete SQL
+        table = E.recordTbl
+        sql   = 'SELECT %s FROM %s' % (','.join(columns), table)
+        vals  = []
+        if orderBy == 'rank':
+            if ftsQuery:
+                rankSql  = ('SELECT rowid AS _rid, bm25(%s) AS _rank'
+                            ' FROM %s WHERE %s MATCH ?')
+                rankSql  = rankSql % ((E.ftsTbl,) * 3)
+                sql     += ' LEFT JOIN (%s) ON _rid = _id' % rankSql
+                vals.append(ftsQuery)
+                orderBy  = '_rank IS NULL, _rank'
+            else:
+                # nothing to rank with, apply the default order
+                orderBy  = E.orderBy
+                orderHow = E.orderHow
+        if whereSql:
+            sql += ' WHERE %s' % whereSql
+            vals.extend(whereVals)
+        orderSql = ' ORDER BY %s %s, id %s' % (orderBy, orderHow, orderHow)
         sql += orderSql
-        if criteria.get('limit'):
-            sql += ' LIMIT %s' % criteria.get('limit')
+        limit = min([x for x in (criteria.get('limit'), page) if x] or [0])
+        if limit:
+            sql += ' LIMIT ?'
+            vals.append(limit)
 
         cur = E.conn.cursor()
         cur.execute(sql, vals)
-        allElements = cur.fetchall()
-        for elements in allElements:
-            D = Record.convertFields(zip(fields, elements))
-            yield D
+        # fetch in batches, the memory use does not grow with
+        # the number of records, and the first ones come fast
+        size  = E.options['fetch_size']
+        count = 0
+        while True:
+            allElements = cur.fetchmany(size)
+            if not allElements:
+                break
+            for elements in allElements:
+                D = E.convertFields(zip(columns, elements), False)
+                count += 1
+                if page:
+                    last = D
+                    D = {k: D[k] for k in fields}
+                yield D
+        if page and count == page:
+            criteria['next'] = E.pageToken(last, orderBy, orderHow)
 
+E.upgrades = [E.upgradeToV2, E.upgradeToV3, E.upgradeToV4,
+              E.upgradeToV5, E.upgradeToV6, E.upgradeToV7, E.upgradeToV8]
 SqliteStorage = E
@@ -0,0 +1,158 @@
+import os, sys
+import time
+import json
+import signal
+from timeutils import isodatetime
+
+class SyncDaemon:
+    """ Keep the remotes in sync in the background
+
+    The HEAD of the xml engine is checked every 'pollTime'
+    seconds, once it has been still for 'quiet' seconds,
+    so that a burst of commits goes in one push, it's pushed
+    to the remotes that don't have it yet. A remote that
+    fails is tried again after 'retryDelay' seconds, doubled
+    on every failure, up to 'maxBackoff'. The remotes are
+    fetched every 'fetchEvery' seconds, the merges update
+    the sqlite engine as a fetch command does.
+
+    The state is written to a file in the git directory,
+    which the status command reads, see readState.
+    """
+    stateName  = 'log-syncd'
+    pollTime   = 2
+    retryDelay = 60
+    maxBackoff = 3600
+
+    def __init__(self, logger, remotes, quiet=30, fetchEvery=600):
+        self.logger     = logger
+        self.git        = logger.git
+        self.remotes    = remotes
+        self.quiet      = quiet
+        self.fetchEvery = fetchEvery
+        self.state      = {
+            'pid':     os.getpid(),
+            'started': int(time.time()),
+            'updated': None,
+            'stopped': None,
+            'remotes': {x: {'pushed': None, 'pushOk': None, 'failures': 0,
+                            'nextPush': 0, 'fetched': None, 'fetchOk': None}
+                            for x in remotes},
+        }
+
+    @staticmethod
+    def statePath(git):
+        return os.path.join(git.gitDir, SyncDaemon.stateName)
+
+    @staticmethod
+    def readState(git):
+        """ Return the state the daemon of the repository of
+        'git' wrote last, a dict, None if there is none, the
+        'running' item tells if the daemon is still alive.
+        """
+        try:
+            state = json.load(open(SyncDaemon.statePath(git)))
+        except (OSError, ValueError):
+            return None
+        state['running'] = not state['stopped'] and SyncDaemon.alive(state['pid'])
+        return state
+
+    @staticmethod
+    def alive(pid):
+        """ Check if the process of pid exists
+        """
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def writeState(self):
+        """ Write the state to the file, a new file replaces
+        the old one, so a reader never sees half of it.
+        """
+        self.state['updated'] = int(time.time())
+        path = self.statePath(self.git)
+        open(path + '.tmp', 'w').write(json.dumps(self.state, indent=4) + '\n')
+        os.replace(path + '.tmp', path)
+
+    def report(self, msg):
+        print('%s %s' % (isodatetime(), msg), flush=True)
+
+    def run(self):
+        """ Work until terminated by a signal or Ctrl-C
+        """
+        old = self.readState(self.git)
+        assert not (old and old['running']), \
+                'syncd is running already, pid %s' % old['pid']
+        signal.signal(signal.SIGTERM, lambda *junk: sys.exit(0))
+        self.report('syncd started, remotes: %s' % ', '.join(self.remotes))
+        self.writeState()
+        lastHead   = self.git.head()
+        lastChange = 0          # push what is pending at the start
+        doneHead   = None       # the head all the remotes have
+        nextFetch  = time.time() if self.fetchEvery else None
+        try:
+            while True:
+                now  = time.time()
+                head = self.git.head()
+                if head != lastHead:
+                    lastHead   = head
+                    lastChange = now
+                if head and head != doneHead and now - lastChange >= self.quiet:
+                    if self.pushRound(head, now):
+                        doneHead = head
+                if nextFetch is not None and now >= nextFetch:
+                    self.fetchRound(now)
+                    nextFetch = now + self.fetchEvery
+                time.sleep(self.pollTime)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.state['stopped'] = int(time.time())
+            self.writeState()
+            self.report('syncd stopped')
+
+    def pushRound(self, head, now):
+        """ Push the head to the remotes that don't have it,
+        and are not waiting after a failure. Return True if
+        all the remotes have it then.
+        """
+        remotes = [x for x in self.remotes
+                    if self.git.syncState(x, 'pushed') != head]
+        waiting = [x for x in remotes
+                    if self.state['remotes'][x]['nextPush'] > now]
+        remotes = [x for x in remotes if x not in waiting]
+        if not remotes:
+            return not waiting
+        self.report('pushing to %s' % ', '.join(remotes))
+        status = self.logger.syncRemotes(remotes, push=True)
+        for remote, ok in status.items():
+            info = self.state['remotes'][remote]
+            info['pushed'] = int(now)
+            info['pushOk'] = ok
+            if ok:
+                info['failures'] = 0
+                info['nextPush'] = 0
+            else:
+                info['failures'] += 1
+                delay = self.retryDelay * 2 ** (info['failures'] - 1)
+                delay = min(delay, self.maxBackoff)
+                info['nextPush'] = int(now + delay)
+                self.report('push to %s failed, next try at %s'
+                            % (remote, isodatetime(info['nextPush'])))
+        self.writeState()
+        return not waiting and all(status.values())
+
+    def fetchRound(self, now):
+        """ Fetch from all the remotes, and merge
+        """
+        self.report('fetching from %s' % ', '.join(self.remotes))
+        status = self.logger.syncRemotes(self.remotes, push=False)
+        for remote, ok in status.items():
+            info = self.state['remotes'][remote]
+            info['fetched'] = int(now)
+            info['fetchOk'] = ok
+        self.writeState()
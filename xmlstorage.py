@@ -4,26 +4,154 @@ from timeutils import isodate
 from git import Git
 import applib
 import re
+import bisect
+import itertools
+from xml.etree import ElementTree
 
 class XmlStorage:
     """ XML storage engine for the record
+
+    The data of a binary record is kept in a file of its
+    own next to the record file, named with blobSuffix.
+
+    The manifest maps the id of every record to its path
+    relative to the data directory, it's kept in the git
+    directory, along with the commit it reflects, and it's
+    brought up to date from git when the commit changes.
     """
+    blobSuffix   = '.blob'
+    # the characters minidom escapes in text, '&' goes first
+    entities     = [('&', '&amp;'), ('<', '&lt;'), ('"', '&quot;'),
+                    ('>', '&gt;'), ('\t', ' ' * 4)]
+    manifestName = 'log-manifest'
+    manifest     = None     # id --> relative path
+    manifestIds  = None     # sorted ids, for prefix matching
+    # searching many records is done by a pool of 'workers'
+    # processes, None means one for each CPU, 1 turns it off,
+    # each process takes 'chunkSize' records at a time
+    workers      = None
+    chunkSize    = 500
+    # the commit to read the records from, through git instead
+    # of the work tree, the engine is read only then
+    rev          = None
 
     @staticmethod
-    def setup(dataDir):
+    def setup(dataDir, workers=None, rev=None):
+        XmlStorage.workers = workers
+        XmlStorage.rev     = rev
         engineDir = os.path.join(dataDir, 'xml')
         os.makedirs(engineDir, exist_ok=True)
         XmlStorage.dataDir = engineDir
         XmlStorage.git     = Git(engineDir)
+        XmlStorage.manifest    = None
+        XmlStorage.manifestIds = None
         return XmlStorage.git
 
     @staticmethod
-    def sourceToDom(code):
+    def manifestPath():
+        return os.path.join(XmlStorage.git.gitDir, XmlStorage.manifestName)
+
+    @staticmethod
+    def getManifest():
+        """ Return the manifest, it's loaded from disk at the
+        first use, and updated if the HEAD has been moved by
+        others, like a merge or a manual git operation.
+        """
+        if XmlStorage.manifest is not None:
+            return XmlStorage.manifest
+        if XmlStorage.rev:      # not kept, the commit never changes
+            return XmlStorage.rebuildManifest()
+        head  = XmlStorage.git.head()
+        entries, mHead = XmlStorage.readManifest()
+        if entries is None:
+            return XmlStorage.rebuildManifest()
+        XmlStorage.manifest = entries
+        if mHead != head:
+            changes = None
+            if mHead and head:
+                changes = XmlStorage.git.diffNameStatus(mHead, head)
+            if changes is None:
+                return XmlStorage.rebuildManifest()
+            for stat, path in changes:
+                if XmlStorage.isRecordPath(path):
+                    XmlStorage.updateManifest(path, stat == 'D')
+            XmlStorage.writeManifest(head)
+        return XmlStorage.manifest
+
+    @staticmethod
+    def readManifest():
+        """ Read the manifest file, return the entries and the
+        commit it reflects, or (None, None) if it's unusable.
+        """
+        try:
+            lines = open(XmlStorage.manifestPath()).read().split('\n')
+        except OSError:
+            return None, None
+        header = lines.pop(0).split(' ')
+        if len(header) != 2 or header[0] != 'head':
+            return None, None
+        head    = header[1] if header[1] != '-' else None
+        entries = dict(x.split('\t', 1) for x in lines if x)
+        return entries, head
+
+    @staticmethod
+    def writeManifest(head):
+        """ Write the manifest to disk, along with the commit
+        'head' it reflects, None for none, which is not read
+        from HEAD, for others may have moved it since. A new
+        file replaces the old one.
+        """
+        if XmlStorage.manifest is None:
+            return
+        path  = XmlStorage.manifestPath()
+        tmp   = '%s.%d.tmp' % (path, os.getpid())
+        lines = ['head %s' % (head or '-')]
+        lines.extend('%s\t%s' % x for x in sorted(XmlStorage.manifest.items()))
+        open(tmp, 'w').write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+    @staticmethod
+    def rebuildManifest():
+        """ Create the manifest from the files in the git index,
+        or from the files of the commit XmlStorage.rev if set,
+        which is not written to disk.
+        """
+        if XmlStorage.rev:
+            paths = XmlStorage.git.lsTree(XmlStorage.rev)
+        else:
+            head  = XmlStorage.git.head()   # at least what the index has
+            paths = XmlStorage.git.lsFiles()
+        paths = filter(XmlStorage.isRecordPath, paths)
+        XmlStorage.manifest    = {os.path.basename(x): x for x in paths}
+        XmlStorage.manifestIds = None
+        if not XmlStorage.rev:
+            XmlStorage.writeManifest(head)
+        return XmlStorage.manifest
+
+    @staticmethod
+    def updateManifest(path, deleted=False):
+        """ Add or remove the record of the path, relative
+        or absolute, in the manifest, if it's loaded.
+        """
+        if XmlStorage.manifest is None:
+            return
+        id = os.path.basename(path)
+        if deleted:
+            XmlStorage.manifest.pop(id, None)
+        else:
+            if os.path.isabs(path):
+                path = os.path.relpath(path, XmlStorage.dataDir)
+            XmlStorage.manifest[id] = path
+        XmlStorage.manifestIds = None
+
+    @staticmethod
+    def sourceToFields(code):
         """ Parse the raw record data which is XML code,
-        return a Xml DOM object.
+        return a dict of the text of the child elements of
+        the root, keyed by the element name.
         """
-        from xml.dom.minidom import parseString
-        return parseString(code)
+        root = ElementTree.fromstring(code)
+        return {node.tag: node.text or '' for node in root}
 
     @staticmethod
     def load(id, path=None):
@@ -33,30 +161,89 @@ class XmlStorage:
         if not path:
             path = XmlStorage.idToPath(id)
         try:
-            code = open(path).read()
-            doc  = XmlStorage.sourceToDom(code)
+            code = XmlStorage.readFile(path)
+        except:
+            return None
+        return XmlStorage.codeToRecord(code, path)
+
+    @staticmethod
+    def codeToRecord(code, path):
+        """ Parse the XML code of the record file of path,
+        return a record instance, or None if it's invalid.
+        """
+        try:
+            fields = XmlStorage.sourceToFields(code)
         except:
             return None
 
-        # collect all fields' data
-        fields = {}
-        for node in doc.firstChild.childNodes:
-            if node.nodeType == node.ELEMENT_NODE:
-                name = node.localName
-                textNode = node.firstChild
-                data = textNode.data if textNode else ''
-                fields[name] = data
         fields = Record.convertFields(fields.items())
+        if fields.get('binary'):
+            fields['data'] = XmlStorage.loadBlob(path, fields.get('data'))
         return Record(**fields)
 
+    @staticmethod
+    def loadPaths(paths):
+        """ Yield the records of the paths, invalid ones are
+        skipped, when reading from a commit, the files are
+        requested from git in a pipeline.
+        """
+        if not XmlStorage.rev:
+            for path in paths:
+                record = XmlStorage.load(None, path)
+                if record:
+                    yield record
+            return
+        paths = [x for x in paths if x]
+        specs = ['%s:%s' % (XmlStorage.rev, os.path.relpath(x, XmlStorage.dataDir))
+                    for x in paths]
+        for path, code in zip(paths, XmlStorage.git.catFiles(specs)):
+            record = XmlStorage.codeToRecord(code, path) if code else None
+            if record:
+                yield record
+
+    @staticmethod
+    def readFile(path):
+        """ Return the content of the file of path, from the
+        commit XmlStorage.rev if set, else from the work tree,
+        or from HEAD if it's not checked out, like in a sparse
+        checkout. Raise FileNotFoundError if it does not exist.
+        """
+        if not XmlStorage.rev:
+            try:
+                return open(path, 'rb').read()
+            except FileNotFoundError:
+                pass
+        relPath = os.path.relpath(path, XmlStorage.dataDir)
+        data    = XmlStorage.git.catFile(XmlStorage.rev or 'HEAD', relPath)
+        if data is None:
+            raise FileNotFoundError(path)
+        return data
+
+    @staticmethod
+    def loadBlob(path, text):
+        """ Return the binary data of the record of path, from
+        the blob file, or from the text, the data was kept in
+        the record file as base64 text before.
+        """
+        try:
+            return XmlStorage.readFile(path + XmlStorage.blobSuffix)
+        except FileNotFoundError:
+            return applib.b64decode(text or '')
+
+    @staticmethod
+    def isRecordPath(path):
+        """ Check if the path is of a record file, whose
+        name is the id of the record, a sha1 sum.
+        """
+        return re.fullmatch('[0-9a-f]{40}', os.path.basename(path)) is not None
+
     @staticmethod
     def idToPath(id):
         """ Find and return the absolute path of a record
         """
-        cmd = 'find %s -name %s' % (XmlStorage.dataDir, id)
-        stat, lines = applib.get_status_text_output(cmd)
-        if stat and lines:
-            return lines[0]
+        path = XmlStorage.getManifest().get(id)
+        if path:
+            return os.path.join(XmlStorage.dataDir, path)
         else:
             return None
 
@@ -64,46 +251,49 @@ class XmlStorage:
     def matchId(id):
         """ Return all IDs that starts with 'id'
         """
-        cmd = 'find %s -name .git -prune -o -name "%s*" -type f -print'
-        cmd = cmd % (XmlStorage.dataDir, id)
-        stat, lines = applib.get_status_text_output(cmd)
-        ids = list(map(os.path.basename, lines))
+        if XmlStorage.manifestIds is None:
+            XmlStorage.manifestIds = sorted(XmlStorage.getManifest())
+        allIds = XmlStorage.manifestIds
+        ids = []
+        idx = bisect.bisect_left(allIds, id)
+        while idx < len(allIds) and allIds[idx].startswith(id):
+            ids.append(allIds[idx])
+            idx += 1
         return ids
 
     @staticmethod
-    def createNode(root, nodeName, nodeText):
-        """ Add an element node with nodeText to the 'root' element
+    def escape(text):
+        """ Escape the text of an element the way
+        minidom does, tabs become four spaces.
         """
-        from xml.dom.minidom import Element, Text
-        ele = Element(nodeName)
-        text = Text()
-        text.data = nodeText
-        ele.appendChild(text)
-        root.appendChild(ele)
+        for char, entity in XmlStorage.entities:
+            if char in text:
+                text = text.replace(char, entity)
+        return text
 
     @staticmethod
     def recordToSource(recordData):
         """ Compose Xml source code from a
         record's data which is a dict object.
+        The layout is what minidom's toprettyxml
+        produces, with the tabs replaced by spaces.
         """
-        from xml.dom.minidom import Document, Text
-        import re
-        doc  = Document()
-        root = doc.createElement("log")
-        doc.appendChild(root)
         items  = dict(recordData).items()
         fields = Record.convertFields(items, False)
+        if recordData.get('binary'):    # kept in the blob file
+            fields['data'] = ''
 
         # sort the fields data according to the definition order
         orders = {k: v['order'] for k, v in Record.fields.items()}
         sortKey = lambda x: orders[x[0]]
         fields = sorted(fields.items(), key=sortKey)
 
+        lines = ['<?xml version="1.0" ?>', '<log>']
         for name, value in fields:
-            XmlStorage.createNode(root, name, value)
-        xmlCode = doc.toprettyxml()
-        xmlCode = re.sub('\t', ' ' * 4, xmlCode)    # replace tabs with spaces
-        return xmlCode
+            value = XmlStorage.escape(value)
+            lines.append('    <%s>%s</%s>' % (name, value, name))
+        lines.append('</log>\n')
+        return '\n'.join(lines)
 
     @staticmethod
     def save(record, oldRecord=None):
@@ -115,8 +305,10 @@ class XmlStorage:
         an existing record. When to change an existing
         log, the new log may be saved to a new directory
         if its timestamp been changed, in such case the
-        old log will be deleted.
+        old log will be deleted. Return None if the
+        commit is not created.
         """
+        assert not XmlStorage.rev, 'the xml engine reads a commit, it is read only'
         paths = []
         if not getattr(record, 'id', None):
             record.id = applib.genId(record.time)
@@ -126,15 +318,19 @@ class XmlStorage:
             commitMsg = 'Change log\n\n%s' % record.id
             if record != oldRecord:
                 path = XmlStorage.idToPath(oldRecord.id)
-                paths.append(path)
-                XmlStorage.__delete(None, path=path)
+                paths.extend(XmlStorage.__delete(None, path=path))
             else:
                 return
         path = XmlStorage.saveRecord(record.elements())
         paths.append(path)
+        if record.binary:
+            paths.append(path + XmlStorage.blobSuffix)
 
         # create a git commit
-        XmlStorage.git.commit(paths, commitMsg)
+        commit = XmlStorage.git.commit(paths, commitMsg)
+        if not commit:
+            return None
+        XmlStorage.writeManifest(commit)
 
         return record
 
@@ -148,53 +344,123 @@ class XmlStorage:
         path = os.path.join(absDirPath, recordData['id'])
         code = XmlStorage.recordToSource(recordData)
         open(path, 'w').write(code)
+        if recordData.get('binary'):
+            XmlStorage.saveBlob(path + XmlStorage.blobSuffix, recordData['data'])
+        if dir == XmlStorage.dataDir:
+            XmlStorage.updateManifest(path)
         return path
 
+    @staticmethod
+    def saveBlob(path, data):
+        """ Write the binary data to the blob file of path,
+        the data is bytes or an applib.FileData.
+        """
+        if isinstance(data, applib.FileData):
+            data.copyTo(path)
+        else:
+            open(path, 'wb').write(data or b'')
+
     @staticmethod
     def allIds():
         """ Return a generator which yields IDs of all log records.
         """
-        dataDir = XmlStorage.dataDir
-        cmd = ['find', dataDir, '-name', '.git',
-               '-prune', '-o', '-type', 'f', '-print0']
-        res = applib.get_status_byte_output(cmd)
-        if not res[0]:
-            print('find command failed:', file=sys.stderr)
-            print(res[2].decode(), file=sys.stderr, end='')
-            return
-
-        lines = res[1].split(b'\x00')[:-1]   # remove the last empty one
-        for path in lines:
-            yield os.path.basename(path.decode())
+        for id in list(XmlStorage.getManifest()):
+            yield id
 
     @staticmethod
     def __delete(id, path=None):
-        """ Delete a record, either by id or by path
+        """ Delete a record, either by id or by path,
+        return the paths of the files deleted, the record
+        file may be gone already, like after a failed commit.
         """
         if not path:
             path = XmlStorage.idToPath(id)
-        os.unlink(path)
+        paths = [path]
+        if os.path.exists(path):
+            os.unlink(path)
+        XmlStorage.updateManifest(path, deleted=True)
+        blobPath = path + XmlStorage.blobSuffix
+        if os.path.exists(blobPath):
+            os.unlink(blobPath)
+            paths.append(blobPath)
+        return paths
 
     @staticmethod
     def delete(ids, preAction=(lambda x:False), postAction=(lambda x:0)):
-        """ Delete multiple records, create a commit
+        """ Delete multiple records, create a commit,
+        return False if the commit is not created.
         """
+        assert not XmlStorage.rev, 'the xml engine reads a commit, it is read only'
         paths = list(map(XmlStorage.idToPath, ids))
         deletedPaths  = []
         deletedBNames = []
         for path in paths:
-            record = XmlStorage.load(None, path)
-            if not preAction(record):
+            record = XmlStorage.load(None, path) if path else None
+            if not record or not preAction(record):
                 continue
-            XmlStorage.__delete(None, path)
+            deletedPaths.extend(XmlStorage.__delete(None, path))
             postAction(record)
-            deletedPaths.append(path)
             deletedBNames.append(record.id)
         if deletedPaths:
             message = 'Delete log\n\n%s' % '\n'.join(deletedBNames)
-            XmlStorage.git.commit(deletedPaths, message)
+            commit  = XmlStorage.git.commit(deletedPaths, message)
+            if not commit:
+                return False
+            XmlStorage.writeManifest(commit)
         return True
 
+    @staticmethod
+    def importRecords(records, commitSize=0):
+        """ Save the records, Record instances with the id
+        set, and commit them through one 'git fast-import',
+        a commit for every 'commitSize' records, or one for
+        all if it's 0. The files are written to the work
+        tree as they go to git, and the index is brought to
+        the new HEAD at the end. Return the number of records.
+        """
+        assert not XmlStorage.rev, 'the xml engine reads a commit, it is read only'
+        git       = XmlStorage.git
+        branch    = git.branch()
+        parent    = git.head()
+        committer = git.committer()
+        assert branch, 'HEAD is detached, no branch to import to'
+        assert committer, 'no committer identity for git'
+        count = 0
+
+        def fileCommand(path, data):
+            path = os.path.relpath(path, XmlStorage.dataDir)
+            return b'M 100644 inline %s\ndata %d\n%s\n' % (
+                        path.encode(), len(data), data)
+
+        def stream():
+            nonlocal count
+            for record in records:
+                if count == 0 or (commitSize and count % commitSize == 0):
+                    message = b'Import log\n'
+                    lines   = [b'commit ' + branch.encode(),
+                               b'committer ' + committer.encode(),
+                               b'data %d' % len(message), message]
+                    if count == 0 and parent:
+                        lines.append(b'from ' + parent.encode())
+                    yield b'\n'.join(lines) + b'\n'
+                path = XmlStorage.saveRecord(record.elements())
+                yield fileCommand(path, open(path, 'rb').read())
+                if record.binary:
+                    data = record.data
+                    if isinstance(data, applib.FileData):
+                        data = data.read()
+                    yield fileCommand(path + XmlStorage.blobSuffix, data)
+                count += 1
+
+        stat = git.fastImport(stream())
+        assert stat, 'git fast-import failed, the records imported ' \
+                     'are left in the work tree'
+        git.resetIndex()
+        # the new commits are not known, the ones after the parent
+        # are brought in again from git when the manifest is read
+        XmlStorage.writeManifest(parent)
+        return count
+
     @staticmethod
     def lastLog():
         """ Fetch the last added/changed log record
@@ -209,30 +475,26 @@ class XmlStorage:
     def lastLogs(count=1):
         """ Fetch the last 'count' logs record
 
-        The paths returned by the git.last may contain
-        paths that been deleted, it shall be ignored.
-
-        When a single record was collected multiple times,
-        the redundant shall be removed.  It can happen
-        when the record was changed multiple times (maybe
-        plus added action) within the range.
+        The history is read from the newest commit backward,
+        the first status of a path is its current state, a
+        path that has been deleted is skipped, so is a path
+        already seen, git is stopped once there are 'count'.
         """
-        vCount = count
-        while True:
-            ps = XmlStorage.git.last(vCount)
-            if len(set(ps)) == count:
-                break
-            else:
-                vCount += 1
         paths = []
-        for p in ps:
-            if p not in paths:
-                paths.append(p)
+        seen  = set()
+        for stat, path in XmlStorage.git.iterNameStatus(XmlStorage.rev or 'HEAD'):
+            if path in seen or not XmlStorage.isRecordPath(path):
+                continue
+            seen.add(path)
+            if stat != 'D':
+                paths.append(path)
+                if len(paths) == count:
+                    break
         records = []
         for path in paths:
             path = os.path.join(XmlStorage.dataDir, path)
-            if os.path.exists(path):
-                record = XmlStorage.load(None, path=path)
+            record = XmlStorage.load(None, path=path)
+            if record:
                 records.append(record)
         return records
 
@@ -243,8 +505,9 @@ class XmlStorage:
         and the time points. The filter function
         expects a Record instance object.
         """
-        def logFilter(record, regexps=regexps, allMatch=allMatch,
-                        tmField=tmField, tmPoints=tmPoints):
+        matcher = XmlStorage.makeMatcher(regexps, allMatch) if regexps else None
+
+        def logFilter(record, matcher=matcher, tmField=tmField, tmPoints=tmPoints):
             """ timeMatch is True if the time of the record is
             within any pair of the tmPoints, regMatch is True
             if any of the provided regular expressions matches
@@ -252,64 +515,169 @@ class XmlStorage:
             field of a record when allMatch is True. Return
             True only when both timeMatch and regMatch are True.
             """
-            timeMatch = regMatch = True
             # match time
             if tmPoints:
                 t = getattr(record, tmField)
-                x = [True for t1, t2 in tmPoints if t1 <= t <= t2]
-                timeMatch = bool(x)
+                for t1, t2 in tmPoints:
+                    if t1 <= t <= t2:
+                        break
+                else:
+                    return False
 
             # match regular expressions
-            if regexps:
+            return matcher(record) if matcher else True
+
+        return logFilter
+
+
+    @staticmethod
+    def makeMatcher(patterns, allMatch=False):
+        """ Compile the patterns once, return a function that
+        tells if a record matches any of them, or all of them
+        when allMatch is True. A pattern with a field matches
+        the field, those are tried first, being cheaper, the
+        others match any text field of the record. Without
+        allMatch, the latter ones of the same flags are joined
+        into one alternation. Only text is matched.
+        """
+        scoped  = []
+        general = []
+        for pat, flag, field in patterns:
+            if field:
+                scoped.append((field, re.compile(pat, flag)))
+            else:
+                general.append((pat, flag))
+        if allMatch:
+            general = [re.compile(pat, flag) for pat, flag in general]
+        else:
+            general = XmlStorage.joinPatterns(general)
+
+        def search(regexp, texts):
+            for text in texts:
+                if isinstance(text, str) and regexp.search(text):
+                    return True
+            return False
+
+        def matcher(record):
+            for field, regexp in scoped:
+                if search(regexp, [getattr(record, field)]) != allMatch:
+                    return not allMatch
+            if general:
                 texts = [record.author, record.subject, record.scene,
                          record.people, record.tag]
                 if not record.binary:
                     texts.append(record.data)
+                for regexp in general:
+                    if search(regexp, texts) != allMatch:
+                        return not allMatch
+            return allMatch
 
-                if allMatch:
-                    def matcher(patterns, inTexts, record):
-                        for pat, flag, field in patterns:
-                            if field:   # match on a specific field
-                                texts = [getattr(record, field)]
-                            else:       # match on input fields
-                                texts = inTexts
-                            match = False
-                            for text in texts:
-                                # if the pattern matches any of
-                                # the text, the pattern is match
-                                if re.search(pat, text, flag):
-                                    match = True
-                                    break
-                            # if any pattern is not match
-                            # the whole failed.
-                            if not match:
-                                return False
-                        return True
-                else:
-                    def matcher(patterns, inTexts, record):
-                        for pat, flag, field in patterns:
-                            if field:   # match on a specific field
-                                texts = [getattr(record, field)]
-                            else:       # match on input fields
-                                texts = inTexts
-                            match = False
-                            for text in texts:
-                                # if the pattern matches any of
-                                # the text, the pattern is match
-                                if re.search(pat, text, flag):
-                                    match = True
-                                    break
-                            # if any pattern is match,
-                            # the whole is match.
-                            if match:
-                                return True
-                        return False
-                regMatch = matcher(regexps, texts, record)
-            return timeMatch and regMatch
+        return matcher
 
-        return logFilter
+
+    @staticmethod
+    def joinPatterns(patterns):
+        """ Compile the list of (pattern, flags), the patterns of
+        the same flags into one alternation, unless one of them
+        has groups, which the numbering of would be broken, or
+        the alternation does not compile, like for an inline flag.
+        Return the list of the compiled.
+        """
+        byFlags = {}
+        for pat, flag in patterns:
+            byFlags.setdefault(flag, []).append(pat)
+        res = []
+        for flag, pats in byFlags.items():
+            regexps = [re.compile(x, flag) for x in pats]
+            if len(pats) > 1 and not any(x.groups for x in regexps):
+                try:
+                    joined  = '|'.join('(?:%s)' % x for x in pats)
+                    regexps = [re.compile(joined, flag)]
+                except re.error:
+                    pass
+            res.extend(regexps)
+        return res
+
+
+    @staticmethod
+    def makeFacetFilter(facets, filter):
+        """ Wrap the filter function, the record also has to
+        match the facets, each of them is (kind, values, allMatch),
+        the same as the sqlite facet table does.
+        """
+        def facetFilter(record):
+            for kind, values, allMatch in facets:
+                have  = set(applib.splitFacet(getattr(record, kind)))
+                found = [x for x in values if x in have]
+                if not found or (allMatch and len(found) != len(values)):
+                    return False
+            return filter(record)
+
+        return facetFilter
 
 
+    @staticmethod
+    def makeSearchFilter(criteria):
+        """ Create the filter function of the time, regular
+        expression and facet criteria.
+        """
+        if criteria and (criteria.get('times') or criteria.get('regxs')):
+            times    = criteria.get('times')
+            tmField  = times.get('field') if times else None
+            tmPoints = times.get('points', []) if times else []
+            regxs    = criteria.get('regxs')
+            allMatch = regxs.get('allMatch', False) if regxs else False
+            patterns = regxs.get('patterns') if regxs else None
+            filter   = XmlStorage.makeFilter(tmField, tmPoints, patterns, allMatch)
+        else:
+            filter = lambda record: True
+        if criteria.get('facets'):
+            filter = XmlStorage.makeFacetFilter(criteria['facets'], filter)
+        return filter
+
+    @staticmethod
+    def searchChunk(paths, criteria, fields, by=None, reverse=False):
+        """ Load the records of the paths, return the 'fields'
+        of those that match the criteria as dicts, sorted by
+        the field 'by' if given, it runs in a worker process
+        of the pool, so everything comes in the arguments.
+        """
+        filter  = XmlStorage.makeSearchFilter(criteria)
+        records = [x for x in XmlStorage.loadPaths(paths) if filter(x)]
+        if by:
+            records.sort(key=(lambda x: getattr(x, by)), reverse=reverse)
+        return [{k: v for k, v in x.elements().items() if k in fields}
+                    for x in records]
+
+    @staticmethod
+    def searchPool(paths, criteria, fields, order):
+        """ Search the records of the paths in a pool of worker
+        processes, each takes a chunk of the paths at a time.
+        Return a generator of the dicts of the 'fields', the
+        sorted chunks are merged when an order is given.
+        """
+        import multiprocessing
+        import functools
+        import heapq
+        size   = XmlStorage.chunkSize
+        chunks = [paths[i:i+size] for i in range(0, len(paths), size)]
+        by     = order['by'] if order else None
+        rev    = not order['ascending'] if order else False
+        pFlds  = set(fields) | ({by} if by else set())
+        search = functools.partial(XmlStorage.searchChunk, criteria=criteria,
+                                   fields=pFlds, by=by, reverse=rev)
+        with multiprocessing.Pool(XmlStorage.workers) as pool:
+            if by:
+                key     = lambda x: x[by]
+                results = heapq.merge(*pool.map(search, chunks),
+                                      key=key, reverse=rev)
+            else:
+                results = itertools.chain.from_iterable(pool.imap(search, chunks))
+            for x in results:
+                if by not in fields:
+                    x.pop(by, None)
+                yield x
+
     @staticmethod
     def searchLogs(fields, criteria, order=None):
         """ Walk through all log records, collect those
@@ -325,6 +693,10 @@ class XmlStorage:
                 d = dict([i for i in r.elements().items() if i[0] in fields])
                 yield d
 
+        # no relevance ranking here, keep the natural order
+        if order and order['by'] not in Record.fields:
+            order = None
+
         # do a git assisted search if the limit is the only criteria
         if criteria.get('limit'):
             ids   = criteria.get('ids')
@@ -332,42 +704,33 @@ class XmlStorage:
             tpnts = times.get('points') if times else None
             regxs = criteria.get('regxs')
             patns = regxs.get('patterns') if regxs else None
-            if not tpnts and not patns and not ids:
+            facets = criteria.get('facets')
+            if not tpnts and not patns and not ids and not facets:
                 records = XmlStorage.lastLogs(criteria['limit'])
                 if order:
                     sortRecords(order['by'], records, reverse=(not order['ascending']))
                 return transRecords(records, fields)
 
-        # create the filter function
-        if criteria and (criteria.get('times') or criteria.get('regxs')):
-            times    = criteria.get('times')
-            tmField  = times.get('field') if times else None
-            tmPoints = times.get('points', []) if times else []
-            regxs    = criteria.get('regxs')
-            allMatch = regxs.get('allMatch', False) if regxs else False
-            patterns = regxs.get('patterns') if regxs else None
-            filter   = XmlStorage.makeFilter(tmField, tmPoints, patterns, allMatch)
-        else:
-            filter = lambda record: True
-
         # the IDs
         ids = criteria.get('ids')
         if not ids:
-            ids = XmlStorage.allIds()
+            ids = list(XmlStorage.allIds())
         else:
             completeIds = []
             for id in ids:
                 completeIds.extend(XmlStorage.matchId(id))
             ids = completeIds
 
+        # many records are loaded and filtered by the pool
+        workers = XmlStorage.workers or os.cpu_count() or 1
+        if workers > 1 and len(ids) >= XmlStorage.chunkSize * 2:
+            paths = [XmlStorage.idToPath(id) for id in ids]
+            return XmlStorage.searchPool(paths, criteria, fields, order)
+
         # collect the records
-        records = []
-        for id in ids:
-            x = XmlStorage.load(id)
-            if not x:
-                continue
-            if filter(x):
-                records.append(x)
+        filter  = XmlStorage.makeSearchFilter(criteria)
+        paths   = [XmlStorage.idToPath(id) for id in ids]
+        records = [x for x in XmlStorage.loadPaths(paths) if filter(x)]
         if order:
             sortRecords(order['by'], records, reverse=(not order['ascending']))
         return transRecords(records, fields)